@@ -0,0 +1,360 @@
+# بنچمارک مسیر پیام‌های گروه
+#
+# آپدیت‌های ساختگی مستقیماً به Dispatcher داده می‌شوند و یک session جعلی به جای
+# تلگرام پاسخ می‌دهد، پس هیچ درخواستی به تلگرام ارسال نمی‌شود.
+#
+#   python benchmark.py                      # دیتابیس درون‌پردازه‌ای
+#   python benchmark.py --db mysql           # MySQL محلی از DB_CONFIG
+#   python benchmark.py --json results.json --max-round-trips 0.5
+#
+# آپدیت‌ها مثل پاسخ‌های getUpdates در دسته‌های ۱۰۰ تایی به update_executor داده می‌شوند و دسته بعدی
+# پس از پردازش دسته قبلی؛ تاخیر هر آپدیت از دریافت تا پایان handler ها (شامل انتظار در صف) است
+#
+# با --max-round-trips اگر تعداد رفت و برگشت دیتابیس به ازای هر پیام در یک سناریو
+# از این مقدار بیشتر شود، خروجی با کد ۱ تمام می‌شود.
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from types import MappingProxyType
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message, Update
+
+import main as bot_main
+import storage
+
+# شناسه کاربران ساختگی، دور از شناسه‌های واقعی تلگرام
+USER_ID_BASE = 9_000_000_000
+# حداکثر تعداد آپدیت در هر پاسخ getUpdates
+POLL_BATCH = 100
+
+MEDIA_FIELDS = {
+    'photo': lambda: [{'file_id': 'p', 'file_unique_id': 'p', 'width': 1, 'height': 1}],
+    'video': lambda: {'file_id': 'v', 'file_unique_id': 'v', 'width': 1, 'height': 1, 'duration': 1},
+    'animation': lambda: {'file_id': 'a', 'file_unique_id': 'a', 'width': 1, 'height': 1, 'duration': 1},
+    'voice': lambda: {'file_id': 'o', 'file_unique_id': 'o', 'duration': 1},
+    'video_note': lambda: {'file_id': 'n', 'file_unique_id': 'n', 'length': 1, 'duration': 1},
+}
+
+
+class FakeSession(BaseSession):
+    # به جای تلگرام پاسخ می‌دهد و فقط تعداد فراخوانی‌ها را نگه می‌دارد
+
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if method.__returning__ is Message:
+            return Message.model_validate({
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': getattr(method, 'chat_id', 0), 'type': 'supergroup'},
+                'text': getattr(method, 'text', None),
+            }, context={'bot': bot})
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class MemoryDatabase:
+    # جایگزین درون‌پردازه‌ای برای run_db؛ فقط کوئری‌های مسیر پیام گروه را پاسخ می‌دهد
+
+    def __init__(self):
+        self.users = {}
+        self.messages = 0
+
+    async def __call__(self, func, *args):
+        if func is bot_main.run_query:
+            query, params = args[0].strip(), args[1] if len(args) > 1 else None
+            if query.startswith('SELECT access_level FROM users'):
+                level = self.users.get(params[0])
+                return [(level,)] if level is not None else []
+            return []
+        if func is bot_main.insert_messages:
+            self.messages += len(args[0])
+            return len(args[0])
+        if func is storage._select_state:
+            return []
+        if func is storage._save_state:
+            return True
+        return None
+
+
+class RoundTripCounter:
+    # شمارش فراخوانی‌های run_db (هر فراخوانی یک رفت و برگشت به دیتابیس است)
+
+    def __init__(self, run_db):
+        self.run_db = run_db
+        self.calls = Counter()
+
+    async def __call__(self, func, *args):
+        self.calls[getattr(func, '__name__', repr(func))] += 1
+        return await self.run_db(func, *args)
+
+
+def make_update(update_id, user_id, content_type, media_group_id=None):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': bot_main.GROUP_ID, 'type': 'supergroup'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+    }
+    if content_type == 'text':
+        message['text'] = 'benchmark'
+    else:
+        message[content_type] = MEDIA_FIELDS[content_type]()
+    if media_group_id:
+        message['media_group_id'] = media_group_id
+    return Update.model_validate({'update_id': update_id, 'message': message},
+                                 context={'bot': bot_main.bot})
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+class Benchmark:
+
+    def __init__(self, db_mode, messages):
+        self.db_mode = db_mode
+        self.messages = messages
+        self.update_ids = itertools.count(1)
+        self.session = FakeSession()
+        self.memory_db = MemoryDatabase()
+        self.registered_level = None
+        self.limited_level = None
+
+    async def setup(self):
+        bot_main.bot.session = self.session
+
+        if self.db_mode == 'memory':
+            run_db = self.memory_db
+            limits = dict.fromkeys(bot_main.LIMIT_COLUMNS, 10 ** 9)
+            bot_main.levels_table = MappingProxyType({
+                1: bot_main.Level(1, 0, MappingProxyType(dict.fromkeys(bot_main.LIMIT_COLUMNS, 1))),
+                2: bot_main.Level(2, 10, MappingProxyType(limits)),
+            })
+        else:
+            bot_main.open_db_pool()
+            await bot_main.prepare_schema()
+            await bot_main.reload_levels()
+            run_db = bot_main.run_db
+        if not bot_main.levels_table:
+            raise RuntimeError('levels table is empty')
+
+        # کاربر ثبت‌نام شده: بالاترین سطح؛ کاربر در آستانه محدودیت: پایین‌ترین سطح
+        self.registered_level = max(bot_main.levels_table)
+        self.limited_level = min(bot_main.levels_table)
+
+        self.round_trips = RoundTripCounter(run_db)
+        bot_main.run_db = self.round_trips
+        if isinstance(bot_main.fsm_storage, storage.MySQLStorage):
+            bot_main.fsm_storage.run_db = self.round_trips
+
+        bot_main.activity_writer.start()
+        bot_main.update_executor.start()
+
+    def reset_outbound(self):
+        # هر سناریو صف خالی و محدودیت‌های تازه دارد تا هشدارهای سناریوی قبلی در نتیجه نیایند
+        old = bot_main.outbound
+        bot_main.outbound = bot_main.OutboundScheduler(
+            bot_main.bot, bot_main.OUTBOUND_GLOBAL_RATE, bot_main.OUTBOUND_CHAT_PER_MINUTE,
+            bot_main.WARNING_WINDOW, bot_main.DELETE_BATCH_WINDOW, bot_main.NOTICE_MAX_AGE)
+        bot_main.outbound.start()
+        return old.stop()
+
+    async def drain_outbound(self):
+        # حذف‌های در انتظار پنجره batch همین حالا ارسال می‌شوند؛
+        # هشدارهایی که به خاطر محدودیت هر چت در صف می‌مانند به عنوان backlog گزارش می‌شوند
+        outbound = bot_main.outbound
+        for chat_id in list(outbound._deletions):
+            outbound._flush_deletions(chat_id)
+        for _ in range(100):
+            if not any(item[0] == bot_main.PRIORITY_DELETE for item in outbound._queue._queue):
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        return len(outbound)
+
+    async def teardown(self):
+        await bot_main.update_executor.stop()
+        await bot_main.outbound.stop()
+        await bot_main.activity_writer.stop()
+        if self.db_mode == 'mysql':
+            await bot_main.execute_query('DELETE FROM users WHERE id >= %s', (USER_ID_BASE,))
+            await bot_main.execute_query('DELETE FROM messages WHERE user_id >= %s', (USER_ID_BASE,))
+            bot_main.close_db_pool()
+
+    async def register_users(self, user_ids, level):
+        if self.db_mode == 'memory':
+            self.memory_db.users.update(dict.fromkeys(user_ids, level))
+            return
+        for user_id in user_ids:
+            await bot_main.execute_query(
+                'INSERT IGNORE INTO users (id, access_level) VALUES (%s, %s)', (user_id, level))
+
+    async def feed(self, updates):
+        latencies = []
+        executor = bot_main.update_executor
+        observe, executor.observe = executor.observe, latencies.append
+        try:
+            for i, update in enumerate(updates, 1):
+                await bot_main.dp.feed_update(bot_main.bot, update)
+                if i % POLL_BATCH == 0:
+                    await executor.join()
+            await executor.join()
+        finally:
+            executor.observe = observe
+        return latencies
+
+    async def feed_albums(self, albums):
+        # تاخیر هر آلبوم: از دریافت اولین بخش تا پایان تصمیم‌گیری کل آلبوم
+        started, latencies = {}, []
+        media_groups = bot_main.media_groups
+        album_handler = media_groups.on_complete
+
+        async def timed_album_handler(messages):
+            await album_handler(messages)
+            latencies.append(time.perf_counter() - started[messages[0].media_group_id])
+
+        media_groups.on_complete = timed_album_handler
+        try:
+            for i, (media_group_id, parts) in enumerate(albums, 1):
+                started[media_group_id] = time.perf_counter()
+                for update in parts:
+                    await bot_main.dp.feed_update(bot_main.bot, update)
+                if i % (POLL_BATCH // len(parts)) == 0:
+                    await bot_main.update_executor.join()
+            await bot_main.update_executor.join()
+            # آلبوم‌هایی که همه بخش‌هایشان رها شده‌اند هیچ‌وقت کامل نمی‌شوند
+            while media_groups._groups or media_groups._tasks:
+                await asyncio.sleep(0.01)
+        finally:
+            media_groups.on_complete = album_handler
+        return latencies
+
+    async def scenario_unregistered_spam(self, first_user):
+        user_ids = range(first_user, first_user + self.messages)
+        return await self.feed([make_update(next(self.update_ids), user_id, 'text') for user_id in user_ids])
+
+    async def scenario_mixed_content(self, first_user):
+        user_ids = list(range(first_user, first_user + 50))
+        await self.register_users(user_ids, self.registered_level)
+        types = ['text', 'photo', 'animation', 'video', 'voice', 'video_note']
+        return await self.feed([
+            make_update(next(self.update_ids), user_ids[i % len(user_ids)], types[i % len(types)])
+            for i in range(self.messages)])
+
+    async def scenario_users_at_limit(self, first_user):
+        user_ids = list(range(first_user, first_user + 50))
+        await self.register_users(user_ids, self.limited_level)
+        limit = bot_main.levels_table[self.limited_level].limits['text']
+        for user_id in user_ids:
+            bot_main.activity_counter.add((user_id, 'text'), n=max(limit, 0))
+        return await self.feed([
+            make_update(next(self.update_ids), user_ids[i % len(user_ids)], 'text')
+            for i in range(self.messages)])
+
+    async def scenario_albums(self, first_user):
+        user_ids = list(range(first_user, first_user + 50))
+        await self.register_users(user_ids, self.registered_level)
+        albums = []
+        for i in range(max(self.messages // 10, 1)):
+            media_group_id = f'bench-{first_user}-{i}'
+            albums.append((media_group_id, [
+                make_update(next(self.update_ids), user_ids[i % len(user_ids)], 'photo', media_group_id)
+                for _ in range(10)]))
+        return await self.feed_albums(albums)
+
+    async def run(self):
+        scenarios = [
+            ('unregistered_spam', self.scenario_unregistered_spam),
+            ('mixed_content', self.scenario_mixed_content),
+            ('users_at_limit', self.scenario_users_at_limit),
+            ('albums', self.scenario_albums),
+        ]
+        results = []
+        await self.setup()
+        try:
+            for index, (name, scenario) in enumerate(scenarios):
+                await self.reset_outbound()
+                self.round_trips.calls.clear()
+                self.session.calls.clear()
+                shed = bot_main.update_executor.shed
+                started = time.perf_counter()
+                latencies = await scenario(USER_ID_BASE + index * 1_000_000)
+                await bot_main.activity_writer.flush()
+                elapsed = time.perf_counter() - started
+                backlog = await self.drain_outbound()
+
+                messages = self.messages if name != 'albums' else len(latencies) * 10
+                shed = bot_main.update_executor.shed - shed
+                round_trips = sum(self.round_trips.calls.values())
+                results.append({
+                    'scenario': name,
+                    'db': self.db_mode,
+                    'messages': messages,
+                    'seconds': round(elapsed, 4),
+                    'messages_per_second': round(messages / elapsed, 1) if elapsed else None,
+                    'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+                    'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+                    'db_round_trips': round_trips,
+                    'shed': shed,
+                    'db_round_trips_per_message': round(round_trips / max(messages - shed, 1), 3),
+                    'db_calls': dict(self.round_trips.calls),
+                    'telegram_calls': dict(self.session.calls),
+                    'outbound_backlog': backlog,
+                })
+        finally:
+            await self.teardown()
+        return results
+
+
+def print_results(results):
+    print(f"{'scenario':<20}{'msgs':>8}{'shed':>8}{'msg/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'db/msg':>9}")
+    for result in results:
+        print(f"{result['scenario']:<20}{result['messages']:>8}{result['shed']:>8}{result['messages_per_second']:>12}"
+              f"{result['p50_ms']:>10}{result['p99_ms']:>10}{result['db_round_trips_per_message']:>9}")
+
+
+async def run_benchmark(args):
+    # لاگ هر آپدیت زمان‌بندی را به هم می‌زند
+    logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+    results = await Benchmark(args.db, args.messages).run()
+    print_results(results)
+
+    if args.json:
+        with open(args.json, mode='w', encoding='utf-8') as file:
+            json.dump({'timestamp': datetime.now().isoformat(), 'results': results}, file, indent=2)
+
+    if args.max_round_trips is not None:
+        failed = [r['scenario'] for r in results if r['db_round_trips_per_message'] > args.max_round_trips]
+        if failed:
+            print(f"DB round trips per message above {args.max_round_trips}: {', '.join(failed)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the group message path')
+    parser.add_argument('--db', choices=['memory', 'mysql'], default='memory')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--json', help='write machine-readable results to this file')
+    parser.add_argument('--max-round-trips', type=float,
+                        help='fail if any scenario exceeds this many DB round trips per message')
+    sys.exit(asyncio.run(run_benchmark(parser.parse_args())))
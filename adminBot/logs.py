@@ -0,0 +1,138 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+from aiogram import BaseMiddleware
+
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# فیلدهای زمینه آپدیت در حال پردازش؛ توسط LogContextMiddleware مقداردهی می‌شوند
+CONTEXT_FIELDS = {
+    'user_id': ContextVar('user_id', default=None),
+    'chat_id': ContextVar('chat_id', default=None),
+    'handler': ContextVar('handler', default=None),
+}
+# زمان شروع handler در حال اجرا (perf_counter)؛ latency هر رکورد نسبت به آن محاسبه می‌شود
+HANDLER_STARTED = ContextVar('handler_started', default=None)
+
+
+class ContextFilter(logging.Filter):
+    # فیلدهای زمینه را به رکورد اضافه می‌کند؛ باید در همان task ثبت‌کننده اجرا شود، نه در ترد listener
+
+    def filter(self, record):
+        for name, var in CONTEXT_FIELDS.items():
+            if getattr(record, name, None) is None:
+                setattr(record, name, var.get())
+        started = HANDLER_STARTED.get()
+        if getattr(record, 'latency', None) is None and started is not None:
+            record.latency = round(time.perf_counter() - started, 6)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    # هر رکورد یک خط JSON؛ فیلدهای خالی حذف می‌شوند
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in (*CONTEXT_FIELDS, 'latency'):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    # اگر صف پر باشد رکورد دور ریخته می‌شود تا ثبت لاگ هیچ‌وقت event loop را متوقف نکند
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler.prepare متن traceback را داخل message می‌گذارد و exc_info را پاک می‌کند،
+        # پس formatter ترد listener (مثلا JsonFormatter) استثنا را نمی‌بیند؛ اینجا traceback جدا در exc_text می‌ماند
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(path, level='INFO', max_bytes=10 * 1024 * 1024, backup_count=5, when=None,
+                  json_format=False, queue_size=10000):
+    # همه handler های root با یک QueueHandler جایگزین می‌شوند؛ نوشتن فایل و stdout در ترد listener انجام می‌شود
+    # when مثلا 'midnight' برای چرخش زمانی؛ در غیر این صورت چرخش بر اساس حجم فایل
+    # برمی‌گرداند: QueueHandler (برای شمارش رکوردهای دور ریخته شده)
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+
+    if when:
+        file_handler = TimedRotatingFileHandler(path, when=when, backupCount=backup_count, encoding='utf-8')
+    else:
+        file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+    # قبل از logging.shutdown اجرا می‌شود، پس رکوردهای باقی‌مانده در صف نوشته می‌شوند
+    atexit.register(listener.stop)
+    return queue_handler
+
+
+class LogContextMiddleware(BaseMiddleware):
+    # user_id، chat_id، نام handler و زمان سپری شده از شروع آن (latency) را به همه لاگ‌های داخل handler اضافه می‌کند
+    # رکورد پایان هر handler فقط در سطح DEBUG ثبت می‌شود تا در حمله‌ها حجم لاگ با تعداد پیام‌ها بالا نرود
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        chat = data.get('event_chat')
+        handler_object = data.get('handler')
+        values = {
+            'user_id': user.id if user else None,
+            'chat_id': chat.id if chat else None,
+            'handler': handler_object.callback.__name__ if handler_object is not None else None,
+        }
+        tokens = [(CONTEXT_FIELDS[name], CONTEXT_FIELDS[name].set(value)) for name, value in values.items()]
+        tokens.append((HANDLER_STARTED, HANDLER_STARTED.set(time.perf_counter())))
+        try:
+            return await handler(event, data)
+        finally:
+            logging.debug('Handler finished')
+            for var, token in reversed(tokens):
+                var.reset(token)
@@ -1,48 +1,139 @@
 import asyncio
+import contextvars
 import logging
-import sys
 import os
 import re
 import csv
+import heapq
+import itertools
+import gzip
+import io
+import tempfile
+import zipfile
+import time
+from collections import Counter, OrderedDict, deque, namedtuple
+from types import MappingProxyType
 from string import digits
 from datetime import timedelta, datetime
+from decimal import Decimal
 
-import mysql.connector
-from mysql.connector import Error
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from operator import itemgetter
 
-from aiogram import Bot, Dispatcher, F, types
+from mysql.connector import Error, IntegrityError, connect, errorcode, pooling
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.dispatcher.event.bases import UNHANDLED
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (Message, KeyboardButton, InlineKeyboardButton,
                            FSInputFile)
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 
-from curl_cffi.requests import AsyncSession
+from curl_cffi.requests import AsyncSession, RequestsError
 
+import config
 from config import BOT_TOKEN, GROUP_ID, BOT_USERNAME, DB_CONFIG, ADMINS_ID, WALLET_ADDRESS
 
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-
-# Set up logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-# Log to file
-file_handler = logging.FileHandler('bot.log')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-
-# root_logger= logging.getLogger()
-# root_logger.addHandler(file_handler)
+import logs
+import metrics
+import schema
+from storage import MySQLStorage
+
+# تنظیمات اختیاری؛ در صورت نبود در config مقدار پیش‌فرض استفاده می‌شود
+DB_POOL_SIZE = getattr(config, 'DB_POOL_SIZE', 8)
+ACTIVITY_EVICT_INTERVAL = getattr(config, 'ACTIVITY_EVICT_INTERVAL', 300)
+ACTIVITY_BATCH_SIZE = getattr(config, 'ACTIVITY_BATCH_SIZE', 200)
+ACTIVITY_FLUSH_MS = getattr(config, 'ACTIVITY_FLUSH_MS', 500)
+# حداکثر ردیف‌های نوشته نشده که هنگام قطعی دیتابیس نگه داشته می‌شوند؛ بیشتر از آن قدیمی‌ترها دور ریخته می‌شوند
+ACTIVITY_MAX_PENDING = getattr(config, 'ACTIVITY_MAX_PENDING', 100000)
+ACCESS_CACHE_SIZE = getattr(config, 'ACCESS_CACHE_SIZE', 10000)
+ACCESS_CACHE_TTL = getattr(config, 'ACCESS_CACHE_TTL', 300)
+ACCESS_CACHE_NEGATIVE_TTL = getattr(config, 'ACCESS_CACHE_NEGATIVE_TTL', 60)
+LEVELS_CHECK_INTERVAL = getattr(config, 'LEVELS_CHECK_INTERVAL', 60)
+# پیام‌های قدیمی‌تر از این افق در message_stats_hourly خلاصه و حذف می‌شوند (حداقل ۱ ساعت)
+MESSAGES_RETENTION_HOURS = max(getattr(config, 'MESSAGES_RETENTION_HOURS', 24), 1)
+MAINTENANCE_INTERVAL = getattr(config, 'MAINTENANCE_INTERVAL', 600)
+MAINTENANCE_BATCH_SIZE = getattr(config, 'MAINTENANCE_BATCH_SIZE', 5000)
+# در صورت True، اگر کوئری‌های پرتکرار full table scan داشته باشند ربات اجرا نمی‌شود
+SCHEMA_STRICT = getattr(config, 'SCHEMA_STRICT', False)
+EXPORT_BATCH_SIZE = getattr(config, 'EXPORT_BATCH_SIZE', 1000)
+TRONSCAN_API_URL = getattr(config, 'TRONSCAN_API_URL', 'https://apilist.tronscan.org')
+TRONSCAN_TIMEOUT = getattr(config, 'TRONSCAN_TIMEOUT', 10)
+TRONSCAN_CONCURRENCY = getattr(config, 'TRONSCAN_CONCURRENCY', 4)
+TRONSCAN_RETRIES = getattr(config, 'TRONSCAN_RETRIES', 3)
+TRONSCAN_CACHE_TTL = getattr(config, 'TRONSCAN_CACHE_TTL', 3600)
+TRONSCAN_NEGATIVE_CACHE_TTL = getattr(config, 'TRONSCAN_NEGATIVE_CACHE_TTL', 60)
+USDT_CONTRACT = getattr(config, 'USDT_CONTRACT', 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t')
+RECONCILE_INTERVAL = getattr(config, 'RECONCILE_INTERVAL', 30)
+RECONCILE_PAGE_SIZE = getattr(config, 'RECONCILE_PAGE_SIZE', 50)
+RECONCILE_MAX_PAGES = getattr(config, 'RECONCILE_MAX_PAGES', 20)
+PENDING_UPGRADE_TTL = getattr(config, 'PENDING_UPGRADE_TTL', 24 * 3600)
+# 'mysql' برای state های ماندگار، 'memory' برای MemoryStorage خود aiogram
+FSM_STORAGE = getattr(config, 'FSM_STORAGE', 'mysql')
+FSM_TTL = getattr(config, 'FSM_TTL', 24 * 3600)
+FSM_CACHE_SIZE = getattr(config, 'FSM_CACHE_SIZE', 1000)
+FSM_EVICT_INTERVAL = getattr(config, 'FSM_EVICT_INTERVAL', 600)
+# True برای اجرای چند worker همزمان: محدودیت‌ها، FSM و ابطال کش از طریق MySQL مشترک می‌شوند
+SHARED_STATE = getattr(config, 'SHARED_STATE', False)
+INVALIDATION_POLL_INTERVAL = getattr(config, 'INVALIDATION_POLL_INTERVAL', 2)
+# محدودیت ارسال به تلگرام: کل ربات (در ثانیه) و هر چت (پیام در دقیقه)
+OUTBOUND_GLOBAL_RATE = getattr(config, 'OUTBOUND_GLOBAL_RATE', 25)
+OUTBOUND_CHAT_PER_MINUTE = getattr(config, 'OUTBOUND_CHAT_PER_MINUTE', 18)
+# هر کاربر در این بازه حداکثر یک هشدار یکسان دریافت می‌کند
+WARNING_WINDOW = getattr(config, 'WARNING_WINDOW', 3600)
+# پیام‌های رد شده هر چت در این بازه جمع و با یک deleteMessages حذف می‌شوند
+DELETE_BATCH_WINDOW = getattr(config, 'DELETE_BATCH_WINDOW', 1.0)
+# هشداری که بیش از این مدت (ثانیه) در صف مانده باشد دیگر ارسال نمی‌شود، مثلا هشدارهای یک حمله تمام شده
+NOTICE_MAX_AGE = getattr(config, 'NOTICE_MAX_AGE', 120)
+# مدت انتظار برای رسیدن بقیه بخش‌های یک آلبوم (media_group_id)
+MEDIA_GROUP_WINDOW = getattr(config, 'MEDIA_GROUP_WINDOW', 0.5)
+# 'polling' یا 'webhook'
+BOT_MODE = getattr(config, 'BOT_MODE', 'polling')
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None)  # آدرس عمومی، مثلا https://bot.example.com
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)
+WEBHOOK_HOST = getattr(config, 'WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8080)
+# endpoint متریک‌های Prometheus؛ با None غیرفعال است
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)
+METRICS_PATH = getattr(config, 'METRICS_PATH', '/metrics')
+# کوئری‌ها و فراخوانی‌های دیتابیس کندتر از این مقدار در لاگ ثبت می‌شوند
+SLOW_QUERY_MS = getattr(config, 'SLOW_QUERY_MS', 200)
+LOG_FILE = getattr(config, 'LOG_FILE', 'bot.log')
+LOG_LEVEL = getattr(config, 'LOG_LEVEL', 'INFO')
+# چرخش فایل لاگ: بر اساس حجم، یا اگر LOG_ROTATE_WHEN تنظیم شده باشد (مثلا 'midnight') بر اساس زمان
+LOG_MAX_BYTES = getattr(config, 'LOG_MAX_BYTES', 10 * 1024 * 1024)
+LOG_BACKUP_COUNT = getattr(config, 'LOG_BACKUP_COUNT', 5)
+LOG_ROTATE_WHEN = getattr(config, 'LOG_ROTATE_WHEN', None)
+# هر رکورد یک خط JSON همراه با user_id، chat_id، handler و latency
+LOG_JSON = getattr(config, 'LOG_JSON', False)
+LOG_QUEUE_SIZE = getattr(config, 'LOG_QUEUE_SIZE', 10000)
+# با SHARED_STATE آمار فعالیت فقط از دیتابیس خوانده می‌شود: هر این مدت پیام‌های جدیدتر از بارگذاری قبلی اضافه می‌شوند
+ACTIVITY_STATS_REFRESH_INTERVAL = getattr(config, 'ACTIVITY_STATS_REFRESH_INTERVAL', 300)
+# پیام‌های این چند ثانیه اخیر ممکن است هنوز در بافر worker ها باشند، پس دور بعد خوانده می‌شوند
+ACTIVITY_STATS_LAG = getattr(config, 'ACTIVITY_STATS_LAG', 30)
+ACTIVITY_TOP_MAX = getattr(config, 'ACTIVITY_TOP_MAX', 50)
+# پردازش همزمان آپدیت‌ها: تعداد worker، حداکثر آپدیت در صف (پس از آن دریافت آپدیت متوقف می‌شود)
+# و طول صفی که از آن به بعد پیام‌های گروه بدون بررسی رها می‌شوند
+UPDATE_WORKERS = getattr(config, 'UPDATE_WORKERS', 16)
+UPDATE_QUEUE_SIZE = getattr(config, 'UPDATE_QUEUE_SIZE', 1000)
+UPDATE_SHED_THRESHOLD = getattr(config, 'UPDATE_SHED_THRESHOLD', 500)
+
+# handler ها فقط رکورد را در صف می‌گذارند؛ نوشتن فایل و stdout در یک ترد جدا انجام می‌شود
+log_handler = logs.setup_logging(LOG_FILE, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_WHEN,
+                                 LOG_JSON, LOG_QUEUE_SIZE)
 
 bot = Bot(token=BOT_TOKEN)
 
-dp = Dispatcher(storage=MemoryStorage())
-
 # User registration states
 
 
@@ -65,188 +156,1656 @@ class AdminPromote(StatesGroup):
 class Upgrade(StatesGroup):
     txn_hash = State()
 
+
+# هش تراکنش ترون: ۶۴ کاراکتر هگز (فاصله‌های ابتدا و انتها در receive_txn_hash حذف می‌شوند)
+TXN_HASH_PATTERN = r'^\s*[0-9a-fA-F]{64}\s*$'
+
+################################################ In-memory state ######################################
+
+
+class SlidingWindowCounter:
+    # شمارنده پنجره لغزان با سطل‌های دقیقه‌ای برای هر کلید (user_id, message_type)
+    # حافظه هر کلید حداکثر window / bucket سطل است و کلیدهای بیکار حذف می‌شوند
+
+    def __init__(self, window=3600, bucket=60):
+        self.window = window
+        self.bucket = bucket
+        self._buckets = {}
+        self._totals = {}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _expire(self, key, now):
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            return 0
+
+        horizon = now - self.window
+        total = self._totals[key]
+        while buckets and buckets[0][0] + self.bucket <= horizon:
+            total -= buckets.popleft()[1]
+
+        if not buckets:
+            del self._buckets[key]
+            del self._totals[key]
+            return 0
+        self._totals[key] = total
+        return total
+
+    def count(self, key, now=None):
+        return self._expire(key, time.time() if now is None else now)
+
+    def add(self, key, now=None, n=1):
+        now = time.time() if now is None else now
+        self._expire(key, now)
+        start = now - now % self.bucket
+        buckets = self._buckets.setdefault(key, deque())
+        if buckets and buckets[-1][0] >= start:
+            buckets[-1][1] += n
+        else:
+            buckets.append([start, n])
+        self._totals[key] = self._totals.get(key, 0) + n
+
+    def evict_idle(self, now=None):
+        now = time.time() if now is None else now
+        for key in list(self._buckets):
+            self._expire(key, now)
+
+
+# پیام‌های پذیرفته شده در ساعت گذشته
+activity_counter = SlidingWindowCounter()
+
+
+class ActivityWindow:
+    # تعداد پیام‌های هر (user_id, message_type) و هر کاربر در یک پنجره لغزان
+    # سطل‌ها بین همه کاربران مشترک‌اند و مجموع‌ها با ورود و خروج هر سطل به‌روز می‌شوند
+
+    def __init__(self, window, bucket):
+        self.window = window
+        self.bucket = bucket
+        self.total = 0
+        self.totals = Counter()
+        self.user_totals = Counter()
+        self._buckets = deque()
+
+    def add(self, user_id, message_type, n, now):
+        start = now - now % self.bucket
+        if not self._buckets or self._buckets[-1][0] < start:
+            self._buckets.append((start, Counter()))
+        self._buckets[-1][1][(user_id, message_type)] += n
+        self.totals[(user_id, message_type)] += n
+        self.user_totals[user_id] += n
+        self.total += n
+
+    def expire(self, now):
+        horizon = now - self.window
+        while self._buckets and self._buckets[0][0] + self.bucket <= horizon:
+            _, counts = self._buckets.popleft()
+            for key, n in counts.items():
+                self.total -= n
+                self.totals[key] -= n
+                if self.totals[key] <= 0:
+                    del self.totals[key]
+                self.user_totals[key[0]] -= n
+                if self.user_totals[key[0]] <= 0:
+                    del self.user_totals[key[0]]
+
+
+class ActivityStats:
+    # آمار فعالیت برای گزارش مدیران؛ با هر پیام پذیرفته شده به‌روز می‌شود تا گزارش به اسکن messages نیاز نداشته باشد
+    # ساعت گذشته با سطل‌های دقیقه‌ای، روز و هفته با سطل‌های ساعتی
+
+    WINDOWS = {
+        'hour': (3600, 60),
+        'day': (24 * 3600, 3600),
+        'week': (7 * 24 * 3600, 3600),
+    }
+
+    def __init__(self):
+        self.windows = {name: ActivityWindow(*spec) for name, spec in self.WINDOWS.items()}
+
+    def add(self, user_id, message_type, n=1, now=None):
+        now = time.time() if now is None else now
+        for window in self.windows.values():
+            window.expire(now)
+            window.add(user_id, message_type, n, now)
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        for window in self.windows.values():
+            window.expire(now)
+
+    def window(self, name, now=None):
+        window = self.windows[name]
+        window.expire(time.time() if now is None else now)
+        return window
+
+    def top_users(self, name, n):
+        # برمی‌گرداند: لیست (user_id, تعداد) به ترتیب نزولی
+        return heapq.nlargest(n, self.window(name).user_totals.items(), key=itemgetter(1))
+
+    def extend(self, rows):
+        # rows: ردیف‌های جدیدتر از همه داده‌های فعلی، با همان قالب rebuild
+        for user_id, message_type, timestamp, count in sorted(rows, key=itemgetter(2)):
+            self.add(user_id, message_type, int(count), timestamp.timestamp())
+
+    def rebuild(self, rows):
+        # rows: (user_id, message_type, datetime, تعداد)؛ جایگزینی یکجا تا گزارش‌ها نیمه‌کاره دیده نشوند
+        windows = {name: ActivityWindow(*spec) for name, spec in self.WINDOWS.items()}
+        now = time.time()
+        for user_id, message_type, timestamp, count in sorted(rows, key=itemgetter(2)):
+            timestamp = timestamp.timestamp()
+            for window in windows.values():
+                if timestamp > now - window.window:
+                    window.add(user_id, message_type, int(count), timestamp)
+        self.windows = windows
+
+
+activity_stats = ActivityStats()
+
+MISSING = object()
+
+
+class AccessLevelCache:
+    # کش LRU/TTL برای user_id -> access_level
+    # None یعنی کاربر ثبت نام نکرده (کش منفی با TTL کوتاه‌تر)
+
+    def __init__(self, maxsize, ttl, negative_ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # user_id -> شماره آخرین ابطال؛ به ترتیب شماره، محدود به maxsize
+        # کاربری که از اینجا حذف شده حداکثر با شماره _forgotten ابطال شده است
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def generation(self):
+        # قبل از کوئری خوانده و به set داده می‌شود
+        return self._generation
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id, access_level, generation=None):
+        # اگر کاربر بعد از generation ابطال شده باشد، نتیجه کوئری ممکن است کهنه باشد و کش نمی‌شود
+        if generation is not None and self._invalidated.get(user_id, self._forgotten) > generation:
+            return
+        ttl = self.ttl if access_level is not None else self.negative_ttl
+        self._entries[user_id] = (access_level, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+        self._generation += 1
+        self._invalidated[user_id] = self._generation
+        self._invalidated.move_to_end(user_id)
+        if len(self._invalidated) > self.maxsize:
+            _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+access_cache = AccessLevelCache(ACCESS_CACHE_SIZE, ACCESS_CACHE_TTL, ACCESS_CACHE_NEGATIVE_TTL)
+
+
+################################################ Metrics ###############################################
+
+
+db_query_seconds = metrics.registry.histogram(
+    'adminbot_db_query_seconds', 'Time spent executing a statement', ['statement'])
+db_query_rows = metrics.registry.counter(
+    'adminbot_db_query_rows_total', 'Rows returned or affected by a statement', ['statement'])
+db_call_seconds = metrics.registry.histogram(
+    'adminbot_db_call_seconds', 'Time spent in run_db, including the wait for a pooled connection', ['func'])
+db_slow_calls = metrics.registry.counter(
+    'adminbot_db_slow_calls_total', f'Statements and run_db calls slower than {SLOW_QUERY_MS} ms', ['name'])
+handler_seconds = metrics.registry.histogram(
+    'adminbot_handler_seconds', 'Time spent in each handler', ['handler'])
+handler_errors = metrics.registry.counter(
+    'adminbot_handler_errors_total', 'Handlers that raised an exception', ['handler'])
+group_messages = metrics.registry.counter(
+    'adminbot_group_messages_total', 'Group messages by type, access level and admission result',
+    ['type', 'level', 'result'])
+metrics.registry.gauge('adminbot_access_cache_hits_total', 'Access level cache hits',
+                       lambda: access_cache.hits, kind='counter')
+metrics.registry.gauge('adminbot_access_cache_misses_total', 'Access level cache misses',
+                       lambda: access_cache.misses, kind='counter')
+metrics.registry.gauge('adminbot_access_cache_size', 'Entries in the access level cache',
+                       lambda: len(access_cache))
+metrics.registry.gauge('adminbot_activity_keys', 'Active (user, type) keys in the sliding window counter',
+                       lambda: len(activity_counter))
+metrics.registry.gauge('adminbot_outbound_queue', 'Telegram calls waiting in the outbound scheduler',
+                       lambda: len(outbound))
+metrics.registry.gauge('adminbot_activity_rows_dropped_total', 'Activity rows dropped because the write buffer was full',
+                       lambda: activity_writer.dropped, kind='counter')
+metrics.registry.gauge('adminbot_outbound_notices_expired_total', 'Warnings dropped after waiting longer than NOTICE_MAX_AGE',
+                       lambda: outbound.expired_notices, kind='counter')
+metrics.registry.gauge('adminbot_log_records_dropped_total', 'Log records dropped because the log queue was full',
+                       lambda: log_handler.dropped, kind='counter')
+
+# متن کوئری بدون فاصله‌های اضافه به عنوان برچسب؛ کوئری‌ها پارامتری هستند پس تعدادشان محدود است
+_statement_labels = {}
+
+
+def statement_label(query):
+    label = _statement_labels.get(query)
+    if label is None:
+        label = _statement_labels[query] = ' '.join(query.split())[:120]
+    return label
+
+
+def record_slow_call(name, elapsed, rows=None):
+    if elapsed * 1000 < SLOW_QUERY_MS:
+        return
+    db_slow_calls.inc(name=name)
+    rows = f', {rows} rows' if rows is not None else ''
+    logging.warning(f"Slow database call ({elapsed * 1000:.0f} ms{rows}): {name}")
+
+
 ################################################ Database functions ####################################
 
 
+db_pool = None
+db_executor = None
+
+
+def open_db_pool():
+    global db_pool, db_executor
+    db_pool = pooling.MySQLConnectionPool(pool_name='adminbot', pool_size=DB_POOL_SIZE,
+                                          pool_reset_session=True, **DB_CONFIG)
+    # یک ترد برای هر کانکشن، تا هیچ کاری منتظر خالی شدن pool نماند
+    db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+
+def close_db_pool():
+    global db_pool, db_executor
+    if db_executor is not None:
+        db_executor.shutdown(wait=True)
+        db_executor = None
+    if db_pool is not None:
+        db_pool._remove_connections()
+        db_pool = None
+
+
 def create_connection():
     try:
-        connection = mysql.connector.connect(**DB_CONFIG)
+        connection = db_pool.get_connection()
         return connection
     except Error as e:
-        print(f'Error connecting to MySQL database: {e}')
+        logging.error(f'Error connecting to MySQL database: {e}')
         return None
 
 
-def execute_query(connection, query, params=None):
+def run_query(connection, query, params=None):
+    started = time.perf_counter()
     try:
         with connection.cursor() as cursor:
             cursor.execute(query, params) if params else cursor.execute(query)
 
             if query.strip().upper().startswith("SELECT"):
-                return cursor.fetchall()
+                result = cursor.fetchall()
+                rows = len(result)
             else:
                 connection.commit()
-                return cursor.rowcount
+                result = rows = cursor.rowcount
 
     except Error as e:
         logging.error(f"Error in query: {e}")
         return None
 
+    elapsed = time.perf_counter() - started
+    statement = statement_label(query)
+    db_query_seconds.observe(elapsed, statement=statement)
+    db_query_rows.inc(max(rows, 0), statement=statement)
+    record_slow_call(statement, elapsed, rows)
+    return result
+
 
-def get_users_from_db():
-    users = []
+def _with_connection(func, *args):
     connection = create_connection()
-    file_path = 'user_info.csv'
-    if connection:
-        try:
-            query = "SELECT * FROM users"
-            rows = execute_query(connection, query)
-            if rows:
-                
-                # ایجاد فایل CSV
-                with open(file_path, mode='w', newline='', encoding='utf-8-sig') as file:
-                    writer = csv.writer(file)
-                    writer.writerow(['ID', 'Twitter ID', 'Telegram ID', 'Age', 'City', 'Gender', 'Purpose', 'Access Level', 'Registration Date'])  # هدر فایل
+    if connection is None:
+        return None
+    try:
+        return func(connection, *args)
+    finally:
+        connection.close()
+
+
+async def run_db(func, *args):
+    # اجرای توابع بلاک‌کننده دیتابیس خارج از event loop با یک کانکشن از pool
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        # ترد دیتابیس زمینه لاگ (user_id، chat_id، handler) آپدیت فراخوان را می‌بیند
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(db_executor, context.run, _with_connection, func, *args)
+    finally:
+        elapsed = time.perf_counter() - started
+        name = func.func.__name__ if isinstance(func, partial) else func.__name__
+        db_call_seconds.observe(elapsed, func=name)
+        # کوئری‌های run_query جداگانه با متن خودشان ثبت می‌شوند
+        if func is not run_query:
+            record_slow_call(name, elapsed)
+
+
+def acquire_named_lock(name):
+    # کانکشن جدا از pool، چون قفل GET_LOCK تا بسته شدن همان کانکشن نگه داشته می‌شود
+    # برمی‌گرداند: کانکشن نگه‌دارنده قفل، یا None اگر قفل دست worker دیگری است
+    try:
+        connection = connect(**DB_CONFIG)
+    except Error as e:
+        logging.error(f"Error connecting for lock {name}: {e}")
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT GET_LOCK(%s, 0)', (f"{DB_CONFIG.get('database')}.{name}",))
+            acquired = cursor.fetchone()[0]
+    except Error as e:
+        logging.error(f"Error acquiring lock {name}: {e}")
+        acquired = None
+    if acquired != 1:
+        connection.close()
+        return None
+    return connection
+
+
+async def run_exclusive(name, job):
+    # با SHARED_STATE فقط worker ای که قفل را گرفته job را اجرا می‌کند و بقیه این دور را رد می‌کنند
+    # اگر worker نگه‌دارنده از کار بیفتد، با قطع کانکشنش قفل آزاد می‌شود
+    if not SHARED_STATE:
+        return await job()
+    loop = asyncio.get_running_loop()
+    connection = await loop.run_in_executor(db_executor, acquire_named_lock, name)
+    if connection is None:
+        return None
+    try:
+        return await job()
+    finally:
+        await loop.run_in_executor(db_executor, connection.close)
+
+
+async def execute_query(query, params=None):
+    return await run_db(run_query, query, params)
+
+
+EXPORT_COLUMNS = ['id', 'twitter_id', 'telegram_id', 'age', 'city', 'gender',
+                  'purpose', 'access_level', 'registration_date']
+EXPORT_HEADER = ['ID', 'Twitter ID', 'Telegram ID', 'Age', 'City', 'Gender',
+                 'Purpose', 'Access Level', 'Registration Date']
+
+
+def _open_export_file(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, mode='wt', newline='', encoding='utf-8-sig'), None
+    if compression == 'zip':
+        archive = zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_DEFLATED)
+        member = archive.open('user_info.csv', mode='w', force_zip64=True)
+        return io.TextIOWrapper(member, newline='', encoding='utf-8-sig'), archive
+    return open(path, mode='w', newline='', encoding='utf-8-sig'), None
+
+
+def get_users_from_db(connection, level=None, registered_from=None, registered_to=None,
+                      active_days=None, compression=None):
+    # خروجی کاربران به صورت جریانی در یک فایل موقت مخصوص همین درخواست
+    conditions, params = [], []
+    if level is not None:
+        conditions.append('access_level = %s')
+        params.append(level)
+    if registered_from is not None:
+        conditions.append('registration_date >= %s')
+        params.append(registered_from)
+    if registered_to is not None:
+        conditions.append('registration_date < %s')
+        params.append(registered_to + timedelta(days=1))
+    if active_days is not None:
+        since = datetime.now() - timedelta(days=active_days)
+        conditions.append('''(
+            EXISTS (SELECT 1 FROM messages m WHERE m.user_id = users.id AND m.timestamp > %s)
+            OR EXISTS (SELECT 1 FROM message_stats_hourly h WHERE h.user_id = users.id AND h.hour > %s)
+        )''')
+        params.extend([since, since])
+
+    query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM users"
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY id'
+
+    suffix = {'gzip': '.csv.gz', 'zip': '.zip'}.get(compression, '.csv')
+    fd, file_path = tempfile.mkstemp(prefix='user_info_', suffix=suffix)
+    os.close(fd)
+    count = 0
+    try:
+        # cursor بدون بافر: ردیف‌ها دسته به دسته از سرور خوانده می‌شوند
+        with connection.cursor(buffered=False) as cursor:
+            cursor.execute(query, params)
+            file, archive = _open_export_file(file_path, compression)
+            try:
+                writer = csv.writer(file)
+                writer.writerow(EXPORT_HEADER)  # هدر فایل
+                while rows := cursor.fetchmany(EXPORT_BATCH_SIZE):
                     writer.writerows(rows)
-        finally:
-            connection.close()
-    return file_path
+                    count += len(rows)
+            finally:
+                file.close()
+                if archive is not None:
+                    archive.close()
+
+    except (Error, OSError) as e:
+        logging.error(f"Error exporting users: {e}")
+        os.remove(file_path)
+        return None
+
+    return file_path, count
+
+
+def parse_export_args(text):
+    # /export level=2 from=2024-01-01 to=2024-02-01 active=7 gzip
+    options = {}
+    for arg in text.split()[1:]:
+        key, _, value = arg.partition('=')
+        if key in ('gzip', 'zip') and not value:
+            options['compression'] = key
+        elif key == 'level':
+            options['level'] = int(value)
+        elif key == 'from':
+            options['registered_from'] = datetime.strptime(value, '%Y-%m-%d')
+        elif key == 'to':
+            options['registered_to'] = datetime.strptime(value, '%Y-%m-%d')
+        elif key == 'active':
+            options['active_days'] = int(value)
+        else:
+            raise ValueError(arg)
+    return options
+
+
+async def prepare_schema():
+    version = await run_db(schema.migrate)
+    if version is None:
+        raise RuntimeError('Could not connect to MySQL to apply schema migrations')
+    logging.info(f"Database schema at version {version}")
+
+    problems = await run_db(schema.explain_hot_paths) or []
+    for name, table in problems:
+        logging.warning(f"!!! Hot-path query {name} does a full table scan on {table}; check its indexes")
+    if problems and SCHEMA_STRICT:
+        raise RuntimeError('Hot-path queries do full table scans; refusing to start')
+
+
+def load_recent_activity(connection):
+    # بازسازی شمارنده‌ها از پیام‌های ساعت گذشته هنگام شروع
+    query = '''
+        SELECT user_id, message_type, MIN(timestamp), COUNT(*)
+        FROM messages
+        WHERE timestamp > %s
+        GROUP BY user_id, message_type, FLOOR(UNIX_TIMESTAMP(timestamp) / 60)
+        ORDER BY MIN(timestamp)
+    '''
+    one_hour_ago = datetime.now() - timedelta(hours=1)
+    rows = run_query(connection, query, (one_hour_ago,))
+    for user_id, message_type, timestamp, count in rows or []:
+        activity_counter.add((user_id, message_type), timestamp.timestamp(), count)
+    return len(activity_counter)
+
+
+def load_activity_stats(connection, since, until):
+    # پیام‌های بازه [since, until): بخش خلاصه شده از message_stats_hourly و بقیه از messages به تفکیک دقیقه
+    hourly = run_query(connection, '''
+        SELECT user_id, message_type, hour, count
+        FROM message_stats_hourly
+        WHERE hour >= %s AND hour < %s
+    ''', (since, until))
+    recent = run_query(connection, '''
+        SELECT user_id, message_type, MIN(timestamp), COUNT(*)
+        FROM messages
+        WHERE timestamp >= %s AND timestamp < %s
+        GROUP BY user_id, message_type, FLOOR(UNIX_TIMESTAMP(timestamp) / 60)
+    ''', (since, until))
+    if hourly is None or recent is None:
+        return None
+    return hourly + recent
+
+
+def insert_messages(connection, rows):
+    query = 'INSERT INTO messages (user_id, message_type, timestamp) VALUES (%s, %s, %s)'
+    try:
+        with connection.cursor() as cursor:
+            # mysql.connector این را به یک INSERT چند ردیفی تبدیل می‌کند
+            cursor.executemany(query, rows)
+            connection.commit()
+            return cursor.rowcount
+
+    except Error as e:
+        logging.error(f"Error in query: {e}")
+        return None
+
+
+class ActivityWriter:
+    # ردیف‌های جدول messages را جمع می‌کند و هر batch_size ردیف
+    # یا هر flush_interval ثانیه (هر کدام زودتر) یکجا می‌نویسد
+
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._rows = []
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    def add(self, user_id, message_type, timestamp=None):
+        self._rows.append((user_id, message_type, timestamp or datetime.now()))
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        # برمی‌گرداند: False اگر نوشتن ناموفق بود؛ ردیف‌ها به ابتدای بافر برمی‌گردند تا دور بعد دوباره نوشته شوند
+        if not self._rows:
+            return True
+        rows, self._rows = self._rows, []
+        if await run_db(insert_messages, rows) is not None:
+            return True
+        self._rows = rows + self._rows
+        overflow = len(self._rows) - self.max_pending
+        if overflow > 0:
+            del self._rows[:overflow]
+            self.dropped += overflow
+            logging.error(f"Activity buffer full, dropped {overflow} oldest rows")
+        logging.error(f"Failed to write {len(rows)} activity rows, will retry")
+        return False
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                if not await self.flush():
+                    # بافر پر هم باشد، تا دور بعد صبر می‌شود تا دیتابیس قطع با درخواست پشت سر هم پر نشود
+                    await asyncio.sleep(self.flush_interval)
+            except Exception:
+                logging.exception("Unexpected error while writing activity rows")
+
+    def start(self):
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+activity_writer = ActivityWriter(ACTIVITY_BATCH_SIZE, ACTIVITY_FLUSH_MS / 1000, ACTIVITY_MAX_PENDING)
+
+
+def rollup_messages_batch(connection, cutoff, batch_size):
+    # خلاصه کردن و حذف حداکثر batch_size ردیف قدیمی در یک تراکنش کوتاه
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT id, user_id, message_type, timestamp
+                FROM messages
+                WHERE timestamp < %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE
+            ''', (cutoff, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                connection.commit()
+                return 0
+
+            counts = {}
+            for _, user_id, message_type, timestamp in rows:
+                hour = timestamp.replace(minute=0, second=0, microsecond=0)
+                key = (user_id, message_type, hour)
+                counts[key] = counts.get(key, 0) + 1
+
+            cursor.executemany('''
+                INSERT INTO message_stats_hourly (user_id, message_type, hour, count)
+                VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+            ''', [(*key, count) for key, count in counts.items()])
+
+            ids = [row[0] for row in rows]
+            cursor.execute(
+                f"DELETE FROM messages WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+            connection.commit()
+            return len(rows)
+
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error in messages rollup: {e}")
+        return None
+
+
+def delete_expired_shared_state(connection, batch_size):
+    # شمارنده‌های قدیمی‌تر از پنجره قبلی و ابطال‌های کش قدیمی‌تر از یک ساعت
+    window_start = datetime.now().replace(minute=0, second=0, microsecond=0)
+    deleted = run_query(connection, 'DELETE FROM rate_counters WHERE window_start < %s LIMIT %s',
+                        (window_start - timedelta(hours=1), batch_size))
+    deleted_invalidations = run_query(connection, 'DELETE FROM cache_invalidations WHERE created_at < %s LIMIT %s',
+                                      (datetime.now() - timedelta(hours=1), batch_size))
+    return (deleted or 0) + (deleted_invalidations or 0)
+
+
+async def rollup_messages():
+    cutoff = datetime.now() - timedelta(hours=MESSAGES_RETENTION_HOURS)
+    total = 0
+    while True:
+        moved = await run_db(rollup_messages_batch, cutoff, MAINTENANCE_BATCH_SIZE)
+        if not moved:
+            break
+        total += moved
+    if total:
+        logging.info(f"Rolled up {total} messages older than {cutoff}")
+
+    if SHARED_STATE:
+        while await run_db(delete_expired_shared_state, MAINTENANCE_BATCH_SIZE):
+            pass
+
+
+async def maintain_messages():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        await run_exclusive('maintain_messages', rollup_messages)
+
+
+async def evict_idle_activity():
+    while True:
+        await asyncio.sleep(ACTIVITY_EVICT_INTERVAL)
+        activity_counter.evict_idle()
+        activity_stats.expire()
+
+
+# انتهای بازه‌ای که تا الان در activity_stats بارگذاری شده
+activity_stats_loaded_until = None
+
+
+async def refresh_activity_stats():
+    # بار اول کل هفته و بعد از آن فقط پیام‌های بعد از بارگذاری قبلی
+    global activity_stats_loaded_until
+    until = datetime.now() - timedelta(seconds=ACTIVITY_STATS_LAG if SHARED_STATE else 0)
+    since = activity_stats_loaded_until or until - timedelta(days=7)
+    rows = await run_db(load_activity_stats, since, until)
+    if rows is None:
+        logging.error("Could not load activity stats")
+        return False
+    if activity_stats_loaded_until is None:
+        activity_stats.rebuild(rows)
+    else:
+        activity_stats.extend(rows)
+    activity_stats_loaded_until = until
+    return True
+
+
+async def watch_activity_stats():
+    # فقط با SHARED_STATE: پیام‌های worker های دیگر هم در آمار دیده شوند
+    while True:
+        await asyncio.sleep(ACTIVITY_STATS_REFRESH_INTERVAL)
+        await refresh_activity_stats()
+
+
+################################################ Update processing #####################################
+
+
+class UpdateExecutor(BaseMiddleware):
+    # outer middleware آپدیت‌ها: هر آپدیت در صف کلید (chat_id, user_id) خودش قرار می‌گیرد و middleware بلافاصله برمی‌گردد
+    # کلیدهای مختلف با حداکثر workers کار همزمان پردازش می‌شوند و آپدیت‌های یک کلید به ترتیب دریافت،
+    # تا مراحل FSM یک کاربر (مثلا Registration) با هم تداخل نداشته باشند
+    # باید قبل از FSMContextMiddleware ثبت شود تا state هر آپدیت بعد از پایان آپدیت قبلی همان کاربر خوانده شود
+
+    def __init__(self, workers, max_pending, shed_threshold, is_sheddable, observe=None):
+        self.workers = workers
+        self.shed_threshold = shed_threshold
+        self.is_sheddable = is_sheddable
+        self.observe = observe
+        self.shed = 0
+        self._pending = 0
+        self._slots = asyncio.Semaphore(max_pending)
+        self._lanes = {}
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = []
+
+    def __len__(self):
+        return self._pending
+
+    async def __call__(self, handler, event, data):
+        if self._pending >= self.shed_threshold and self.is_sheddable(event):
+            self.shed += 1
+            return UNHANDLED
+
+        # با صف پر، polling (یا درخواست webhook) تا آزاد شدن جا منتظر می‌ماند
+        await self._slots.acquire()
+        self._pending += 1
+        self._idle.clear()
+
+        chat, user = data.get('event_chat'), data.get('event_from_user')
+        key = (chat.id if chat else None, user.id if user else None)
+        job = (handler, event, data, time.perf_counter())
+        lane = self._lanes.get(key)
+        if lane is None:
+            self._lanes[key] = deque([job])
+            self._ready.put_nowait(key)
+        else:
+            lane.append(job)
+
+    async def _work(self):
+        while True:
+            key = await self._ready.get()
+            lane = self._lanes[key]
+            handler, event, data, received = lane.popleft()
+            try:
+                await handler(event, data)
+            except Exception:
+                logging.exception(f"Error while processing update {event.update_id}")
+            finally:
+                self._pending -= 1
+                self._slots.release()
+                if self.observe is not None:
+                    self.observe(time.perf_counter() - received)
+                # کلید به انتهای صف برمی‌گردد تا یک کاربر پرکار بقیه را معطل نکند
+                if lane:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._lanes[key]
+                if not self._pending:
+                    self._idle.set()
+
+    async def join(self):
+        await self._idle.wait()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        # فرصت برای تمام شدن آپدیت‌های دریافت شده، سپس لغو worker ها
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Stopping with {self._pending} updates still queued")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+def is_group_enforcement(update):
+    # فقط بررسی محدودیت پیام‌های گروه قابل رها کردن است؛ ثبت نام و پرداخت همیشه پردازش می‌شوند
+    return update.message is not None and update.message.chat.id == GROUP_ID
+
+
+update_seconds = metrics.registry.histogram(
+    'adminbot_update_seconds', 'Time from receiving an update until its handlers finished, including queueing')
+update_executor = UpdateExecutor(UPDATE_WORKERS, UPDATE_QUEUE_SIZE, UPDATE_SHED_THRESHOLD, is_group_enforcement,
+                                 update_seconds.observe)
+metrics.registry.gauge('adminbot_update_queue', 'Updates received but not yet processed',
+                       lambda: len(update_executor))
+metrics.registry.gauge('adminbot_updates_shed_total', 'Group messages skipped because the update queue was too long',
+                       lambda: update_executor.shed, kind='counter')
+
+
+if FSM_STORAGE == 'mysql':
+    # با چند worker کش محلی FSM غیرفعال است تا همه یک state را ببینند
+    fsm_storage = MySQLStorage(run_db, FSM_TTL, 0 if SHARED_STATE else FSM_CACHE_SIZE)
+elif SHARED_STATE:
+    raise RuntimeError("SHARED_STATE requires FSM_STORAGE = 'mysql'")
+else:
+    fsm_storage = MemoryStorage()
+
+class SkipGroupFSM(BaseMiddleware):
+    # هیچ handler گروه از state استفاده نمی‌کند؛ خواندن FSM برای هر پیام گروه یک رفت و برگشت اضافه به دیتابیس است
+
+    def __init__(self, fsm):
+        self.fsm = fsm
+
+    async def __call__(self, handler, event, data):
+        chat = data.get('event_chat')
+        if chat is not None and chat.id == GROUP_ID:
+            return await handler(event, data)
+        return await self.fsm(handler, event, data)
+
+
+# FSMContextMiddleware بعد از UpdateExecutor ثبت می‌شود
+dp = Dispatcher(storage=fsm_storage, disable_fsm=True)
+dp.update.outer_middleware(update_executor)
+dp.update.outer_middleware(SkipGroupFSM(dp.fsm))
+dp.message.middleware(logs.LogContextMiddleware())
+dp.callback_query.middleware(logs.LogContextMiddleware())
+dp.message.middleware(metrics.HandlerTimingMiddleware(handler_seconds, handler_errors))
+dp.callback_query.middleware(metrics.HandlerTimingMiddleware(handler_seconds, handler_errors))
+
+
+async def evict_fsm_states():
+    while True:
+        await asyncio.sleep(FSM_EVICT_INTERVAL)
+        evicted = await fsm_storage.evict_expired()
+        if evicted:
+            logging.info(f"Evicted {evicted} abandoned FSM states")
+
+
+################################################ Outbound Telegram calls ###############################
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        # چند ثانیه تا آماده شدن یک توکن
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+# اولویت کمتر زودتر ارسال می‌شود
+PRIORITY_DELETE = 0
+PRIORITY_NOTICE = 1
+
+
+class OutboundScheduler:
+    # صف ارسال درخواست‌ها به تلگرام با token bucket کلی و برای هر چت،
+    # رعایت retry_after و اولویت حذف پیام‌ها بر اطلاعیه‌ها
+
+    # حداکثر تعداد پیام در یک درخواست deleteMessages
+    MAX_DELETE_BATCH = 100
+
+    def __init__(self, bot, global_rate, chat_per_minute, warning_window, delete_window, notice_max_age):
+        self.bot = bot
+        self.warning_window = warning_window
+        self.chat_per_minute = chat_per_minute
+        self.delete_window = delete_window
+        self.notice_max_age = notice_max_age
+        self.expired_notices = 0
+        self._deletions = {}
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        # کلید هشدار -> زمان انقضا؛ بازه برای همه یکسان است پس به ترتیب انقضا مرتب‌اند
+        self._warned = OrderedDict()
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._parked = 0
+        # حذف‌های صف شده یا در حال ارسال، برای ارسال آن‌ها قبل از خروج
+        self._deletes = 0
+        self._deletes_idle = asyncio.Event()
+        self._deletes_idle.set()
+        self._task = None
+
+    def __len__(self):
+        return self._queue.qsize() + self._parked
+
+    def submit(self, priority, chat_id, call, expires=False):
+        # call تابع بدون آرگومانی است که coroutine درخواست را می‌سازد
+        # با expires اگر بیش از notice_max_age ثانیه در صف بماند دور ریخته می‌شود (فقط هشدارهای warn_once)
+        deadline = time.monotonic() + self.notice_max_age if expires else None
+        if priority == PRIORITY_DELETE:
+            self._deletes += 1
+            self._deletes_idle.clear()
+        self._queue.put_nowait((priority, next(self._order), chat_id, call, deadline))
+
+    def warn_once(self, chat_id, key, call):
+        # ارسال هشدار فقط اگر همین هشدار در بازه اخیر ارسال نشده باشد
+        now = time.monotonic()
+        while self._warned:
+            oldest, expires = next(iter(self._warned.items()))
+            if expires > now:
+                break
+            del self._warned[oldest]
+        if key in self._warned:
+            return False
+        self._warned[key] = now + self.warning_window
+        self.submit(PRIORITY_NOTICE, chat_id, call, expires=True)
+        return True
+
+    def delete_message(self, chat_id, message_id):
+        pending = self._deletions.setdefault(chat_id, [])
+        pending.append(message_id)
+        if len(pending) >= self.MAX_DELETE_BATCH:
+            self._flush_deletions(chat_id)
+        elif len(pending) == 1:
+            asyncio.get_running_loop().call_later(self.delete_window, self._flush_deletions, chat_id)
+
+    def _flush_deletions(self, chat_id):
+        message_ids = self._deletions.pop(chat_id, None)
+        if message_ids:
+            self.submit(PRIORITY_DELETE, chat_id, partial(self._delete_batch, chat_id, message_ids))
+
+    async def _delete_batch(self, chat_id, message_ids):
+        if len(message_ids) == 1:
+            await self.bot.delete_message(chat_id, message_ids[0])
+            return
+        try:
+            await self.bot.delete_messages(chat_id, message_ids)
+        except TelegramBadRequest as e:
+            # مثلا پیام‌های خیلی قدیمی؛ حذف تک‌تک تا بقیه پیام‌ها باقی نمانند
+            logging.warning(f"Bulk delete in chat {chat_id} failed ({e}), deleting one by one")
+            for message_id in message_ids:
+                self.submit(PRIORITY_DELETE, chat_id, partial(self.bot.delete_message, chat_id, message_id))
+
+    def _unpark(self, item):
+        self._parked -= 1
+        self._queue.put_nowait(item)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_per_minute / 60, self.chat_per_minute)
+        return bucket
+
+    async def _run(self):
+        while True:
+            item = priority, order, chat_id, call, deadline = await self._queue.get()
+            if deadline is not None and deadline < time.monotonic():
+                self.expired_notices += 1
+                continue
+            # حذف پیام‌ها فقط محدودیت کلی را رعایت می‌کنند؛ اطلاعیه‌ای که محدودیت چتش پر است
+            # تا آزاد شدن ظرفیت کنار گذاشته می‌شود تا حذف‌ها و چت‌های دیگر پشت آن نمانند
+            chat_bucket = None
+            if priority != PRIORITY_DELETE:
+                chat_bucket = self._chat_bucket(chat_id)
+                if (wait := chat_bucket.delay()) > 0:
+                    self._parked += 1
+                    asyncio.get_running_loop().call_later(wait, self._unpark, item)
+                    continue
+            while (wait := self._global.delay()) > 0:
+                await asyncio.sleep(wait)
+            self._global.take()
+            if chat_bucket is not None:
+                chat_bucket.take()
+
+            try:
+                await call()
+            except TelegramRetryAfter as e:
+                logging.warning(f"Flood control on chat {chat_id}, retrying after {e.retry_after}s")
+                self._queue.put_nowait(item)
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramAPIError as e:
+                logging.error(f"Telegram request to chat {chat_id} failed: {e}")
+            except Exception:
+                # مثلا ClientDecodeError برای صفحه 502 یک proxy؛ تنها task ارسال نباید متوقف شود
+                logging.exception(f"Unexpected error in Telegram request to chat {chat_id}")
+            if priority == PRIORITY_DELETE:
+                self._deletes -= 1
+                if not self._deletes:
+                    self._deletes_idle.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10):
+        # حذف‌های batch نشده و صف شده قبل از خروج ارسال می‌شوند تا پیام‌های رد شده در گروه نمانند؛
+        # اطلاعیه‌های باقی‌مانده رها می‌شوند
+        for chat_id in list(self._deletions):
+            self._flush_deletions(chat_id)
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._deletes_idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Stopping with {self._deletes} message deletions still queued")
+        self._task.cancel()
+        self._task = None
+
+
+outbound = OutboundScheduler(bot, OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_PER_MINUTE, WARNING_WINDOW,
+                             DELETE_BATCH_WINDOW, NOTICE_MAX_AGE)
+
+
+################################################ Blockchain functions ##################################
+
+
+class TronscanClient:
+    # یک نشست HTTP ماندگار با timeout، محدودیت همزمانی، تلاش مجدد و کش نتایج بر اساس هش
+
+    def __init__(self, base_url, timeout, concurrency, retries, cache_ttl, negative_ttl,
+                 cache_size=1024):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.retries = retries
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.cache_size = cache_size
+        self.session = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._cache = OrderedDict()
+        self._inflight = {}
+
+    def start(self):
+        self.session = AsyncSession(max_clients=self.concurrency, timeout=self.timeout,
+                                    impersonate='chrome')
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request_json(self, path, params=None):
+        # برمی‌گرداند: (داده، قطعی)؛ داده None یعنی پاسخ معتبری دریافت نشد
+        # و قطعی یعنی خطای 4xx (غیر از 429) که با تلاش مجدد تغییر نمی‌کند
+        for attempt in range(self.retries):
+            if attempt:
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                async with self._semaphore:
+                    response = await self.session.get(f'{self.base_url}{path}', params=params)
+                if response.ok:
+                    return response.json(), True
+                if response.status_code != 429 and response.status_code < 500:
+                    logging.error(f"Tronscan {path} returned {response.status_code}")
+                    return None, True
+                logging.warning(f"Tronscan {path} returned {response.status_code}, retrying")
+            except (RequestsError, ValueError) as e:
+                logging.warning(f"Tronscan {path} failed: {e}, retrying")
+        logging.error(f"Tronscan {path} failed after {self.retries} attempts")
+        return None, False
+
+    async def get_json(self, path, params=None):
+        # None یعنی پاسخ معتبری بعد از همه تلاش‌ها دریافت نشد
+        data, _ = await self._request_json(path, params)
+        return data
+
+    async def get_transfer(self, txn_hash):
+        # اطلاعات انتقال توکن یک تراکنش؛ نتایج قطعی (مثبت یا منفی) کش می‌شوند
+        entry = self._cache.get(txn_hash)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+
+        # درخواست‌های همزمان برای یک هش فقط یک بار به API می‌روند
+        task = self._inflight.get(txn_hash)
+        if task is None:
+            task = asyncio.ensure_future(self._request_json('/api/transaction-info', {'hash': txn_hash}))
+            self._inflight[txn_hash] = task
+            task.add_done_callback(lambda _: self._inflight.pop(txn_hash, None))
+        data, definitive = await asyncio.shield(task)
+        # خطای موقت کش نمی‌شود؛ پاسخ 4xx مثل نبودن انتقال با negative_ttl کش می‌شود
+        if data is None and not definitive:
+            return None
+
+        transfer = data.get('tokenTransferInfo', None) if data is not None else None
+        ttl = self.cache_ttl if transfer else self.negative_ttl
+        self._cache[txn_hash] = (transfer, time.monotonic() + ttl)
+        self._cache.move_to_end(txn_hash)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return transfer
+
+
+tronscan = TronscanClient(TRONSCAN_API_URL, TRONSCAN_TIMEOUT, TRONSCAN_CONCURRENCY, TRONSCAN_RETRIES,
+                          TRONSCAN_CACHE_TTL, TRONSCAN_NEGATIVE_CACHE_TTL)
+
+
+def to_units(amount):
+    # USDT روی ترون ۶ رقم اعشار دارد
+    return int(Decimal(str(amount)) * 1000000)
+
+
+def from_units(units):
+    return format(Decimal(units) / 1000000, 'f')
+
+
+async def fetch_incoming_transfers(since_ms):
+    # واریزهای USDT به کیف پول از since_ms به بعد، صفحه به صفحه و از قدیمی به جدید
+    # تا اگر به RECONCILE_MAX_PAGES رسیدیم، واریزهای جدیدتر در دور بعد خوانده شوند
+    transfers = []
+    for page in range(RECONCILE_MAX_PAGES):
+        data = await tronscan.get_json('/api/token_trc20/transfers', {
+            'toAddress': WALLET_ADDRESS,
+            'contract_address': USDT_CONTRACT,
+            'start_timestamp': since_ms,
+            'start': page * RECONCILE_PAGE_SIZE,
+            'limit': RECONCILE_PAGE_SIZE,
+            'sort': 'timestamp',
+            'confirm': 'true',
+        })
+        if data is None:
+            return None
+        batch = data.get('token_transfers') or []
+        transfers.extend(batch)
+        if len(batch) < RECONCILE_PAGE_SIZE:
+            break
+    transfers.sort(key=lambda transfer: int(transfer.get('block_ts', 0)))
+    return transfers
 
 
 ################################################ Helper functions ######################################
 
 
+def get_last_invalidation_id(connection):
+    rows = run_query(connection, 'SELECT COALESCE(MAX(id), 0) FROM cache_invalidations')
+    return rows[0][0] if rows else 0
+
+
+async def invalidate_user(user_id):
+    access_cache.invalidate(user_id)
+    if SHARED_STATE:
+        await execute_query('INSERT INTO cache_invalidations (user_id) VALUES (%s)', (user_id,))
+
+
+async def watch_invalidations():
+    # اعمال ابطال‌های کش ثبت شده توسط worker های دیگر
+    last_id = await run_db(get_last_invalidation_id) or 0
+    while True:
+        await asyncio.sleep(INVALIDATION_POLL_INTERVAL)
+        rows = await execute_query(
+            'SELECT id, user_id FROM cache_invalidations WHERE id > %s ORDER BY id', (last_id,))
+        for invalidation_id, user_id in rows or []:
+            access_cache.invalidate(user_id)
+            last_id = invalidation_id
+
+
 async def is_user_registered(user_id):
-    conn = create_connection()
-    if conn is not None:
-        try:
-            query = 'SELECT * FROM users WHERE id = %s'
-            result = execute_query(conn, query, (user_id,))
-            if result:
-                return True
-        finally:
-            conn.close()
-    return False
+    return await get_user_access_level(user_id) is not None
 
 
 async def get_access_levels():
-    conn = create_connection()
-    if conn is not None:
-        try:
-            query = 'SELECT level, price FROM levels ORDER BY level'
-            result = execute_query(conn, query)
-            if result:
-                return result
-        finally:
-            conn.close()
+    if levels_table:
+        return list(levels_table.values())
     return False
 
 
 async def get_user_access_level(user_id):
-    conn = create_connection()
-    if conn is not None:
-        try:
-            query = 'SELECT access_level FROM users WHERE id = %s'
-            result = execute_query(conn, query, (user_id,))
-            return result[0][0] if result else None
-        finally:
-            conn.close()
-    return None
+    access_level = access_cache.get(user_id)
+    if access_level is not MISSING:
+        return access_level
+
+    query = 'SELECT access_level FROM users WHERE id = %s'
+    generation = access_cache.generation()
+    result = await execute_query(query, (user_id,))
+    if result is None:  # خطای دیتابیس؛ کش نمی‌شود
+        return None
+    access_level = result[0][0] if result else None
+    access_cache.set(user_id, access_level, generation)
+    return access_level
+
+
+async def get_users_access_levels(user_ids):
+    # برمی‌گرداند: نگاشت user_id -> access_level؛ کاربرانی که در کش نیستند با یک کوئری برای هر ۱۰۰۰ کاربر
+    levels, missing = {}, []
+    for user_id in user_ids:
+        access_level = access_cache.get(user_id)
+        if access_level is MISSING:
+            missing.append(user_id)
+        else:
+            levels[user_id] = access_level
+
+    for i in range(0, len(missing), 1000):
+        chunk = missing[i:i + 1000]
+        query = f"SELECT id, access_level FROM users WHERE id IN ({', '.join(['%s'] * len(chunk))})"
+        generation = access_cache.generation()
+        result = await execute_query(query, chunk)
+        if result is None:
+            continue
+        found = dict(result)
+        for user_id in chunk:
+            levels[user_id] = found.get(user_id)
+            access_cache.set(user_id, found.get(user_id), generation)
+    return levels
+
+
+async def get_users_near_limits(n):
+    # n کاربری که در ساعت گذشته بیشترین نسبت مصرف به محدودیت ساعتی را داشته‌اند
+    # برمی‌گرداند: لیست (نسبت، user_id، سطح، نوع پیام، تعداد، محدودیت)
+    window = activity_stats.window('hour')
+    levels = await get_users_access_levels(list(window.user_totals))
+    closest = {}
+    for (user_id, message_type), count in window.totals.items():
+        level = levels_table.get(levels.get(user_id))
+        limit = level.limits.get(message_type) if level else None
+        if not limit or limit < 0:  # بدون سطح، غیرمجاز یا نامحدود
+            continue
+        entry = (count / limit, user_id, level.level, message_type, count, limit)
+        if user_id not in closest or entry > closest[user_id]:
+            closest[user_id] = entry
+    return heapq.nlargest(n, closest.values())
+
+
+# نتیجه بررسی پیام گروه
+ADMIT_OK = 'ok'
+ADMIT_UNREGISTERED = 'unregistered'
+ADMIT_LIMIT_REACHED = 'limit_reached'
+
+# نوع پیام -> ستون محدودیت در جدول levels
+LIMIT_COLUMNS = {
+    'text': 'text_limit',
+    'animation': 'gif_limit',
+    'photo': 'photo_limit',
+    'video': 'video_limit',
+    'video_note': 'video_note_limit',
+    'voice': 'voice_limit',
+}
+
+# یک سطح دسترسی؛ limits نگاشت نوع پیام -> محدودیت ساعتی است
+Level = namedtuple('Level', ['level', 'price', 'limits'])
+
+# جدول levels در حافظه؛ فقط با جایگزینی کامل به‌روز می‌شود
+levels_table = MappingProxyType({})
+levels_checksum = None
+
+
+def load_levels(connection):
+    query = f'''
+        SELECT level, price, {', '.join(LIMIT_COLUMNS.values())}
+        FROM levels
+        ORDER BY level
+    '''
+    rows = run_query(connection, query)
+    checksum = get_levels_checksum(connection)
+    if rows is None or checksum is None:
+        return None
 
+    table = {}
+    for level, price, *limits in rows:
+        table[level] = Level(level, price, MappingProxyType(dict(zip(LIMIT_COLUMNS, limits))))
+    return MappingProxyType(table), checksum
 
-async def check_message_limits(user_id, message_type):
-    access_level = await get_user_access_level(user_id)
-    if access_level is None:
+
+def get_levels_checksum(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('CHECKSUM TABLE levels')
+            return cursor.fetchone()[1]
+
+    except Error as e:
+        logging.error(f"Error in query: {e}")
+        return None
+
+
+async def reload_levels():
+    global levels_table, levels_checksum
+    loaded = await run_db(load_levels)
+    if loaded is None:
+        logging.error("Failed to load levels table")
         return False
+    levels_table, levels_checksum = loaded
+    logging.info(f"Loaded {len(levels_table)} access levels")
+    return True
 
-    conn = create_connection()
-    if conn is not None:
-        try:
 
-            query = '''
-                SELECT text_limit, gif_limit, photo_limit, video_limit, 
-                    video_note_limit, voice_limit 
-                FROM levels 
-                WHERE level = %s
-            '''
-            limits = execute_query(conn, query, (access_level,))
-
-            if not limits:
-                logging.error(
-                    f"No limits found for access level {access_level}")
-                return False
-
-            limit_types = ['text', 'animation',
-                           'photo', 'video', 'video_note', 'voice']
-            limits_dict = dict(zip(limit_types, limits[0]))
-
-            if message_type not in limits_dict:
-                logging.warning(f"Unknown message type: {message_type}")
-                return False
-
-            limit = limits_dict[message_type]
-
-            if limit == 0:
-                return False
-            elif limit == -1:  # نامحدود
-                return True
-            else:
-                # بررسی تعداد پیام‌ها در ساعت گذشته
-                one_hour_ago = datetime.now() - timedelta(hours=1)
-                query = '''
-                    SELECT COUNT(*) 
-                    FROM messages 
-                    WHERE user_id = %s AND message_type = %s AND timestamp > %s
-                '''
-                result = execute_query(
-                    conn, query, (user_id, message_type, one_hour_ago))
-
-                if result:
-                    count = result[0][0]
-                    return count < limit
-                else:
-                    logging.error(
-                        f"Failed to get message count for user {user_id}")
+async def watch_levels():
+    # بارگذاری مجدد جدول levels در صورت تغییر checksum
+    while True:
+        await asyncio.sleep(LEVELS_CHECK_INTERVAL)
+        checksum = await run_db(get_levels_checksum)
+        if checksum is not None and checksum != levels_checksum:
+            await reload_levels()
+
+
+async def admit_messages(user_id, counts):
+    # پذیرش یکجای چند پیام (مثلا یک آلبوم)؛ counts نگاشت نوع پیام -> تعداد است
+    # یا همه پذیرفته می‌شوند یا هیچ‌کدام
+    # سطح دسترسی از کش، محدودیت‌ها و تعداد پیام‌های ساعت گذشته از حافظه
+    access_level = await get_user_access_level(user_id)
+    allowed, reason = await _admit_messages(user_id, access_level, counts)
+    for message_type, count in counts.items():
+        group_messages.inc(count, type=message_type, level=access_level or 0, result=reason)
+    return allowed, reason
+
+
+async def _admit_messages(user_id, access_level, counts):
+    if not access_level:
+        return False, ADMIT_UNREGISTERED
+
+    level = levels_table.get(access_level)
+    if level is None:
+        logging.error(f"No limits found for access level {access_level}")
+        return False, ADMIT_LIMIT_REACHED
+
+    quotas = {}
+    for message_type, count in counts.items():
+        limit = level.limits.get(message_type)
+        if limit is None:
+            logging.warning(f"Unknown message type: {message_type}")
+            return False, ADMIT_LIMIT_REACHED
+        if limit == 0 or (limit != -1 and count > limit):
+            return False, ADMIT_LIMIT_REACHED
+        if limit != -1:  # -1: نامحدود
+            quotas[message_type] = (limit, count)
+
+    if SHARED_STATE:
+        if quotas and not await run_db(reserve_shared_quota, user_id, quotas):
+            return False, ADMIT_LIMIT_REACHED
+        return True, ADMIT_OK
+
+    for message_type, (limit, count) in quotas.items():
+        if activity_counter.count((user_id, message_type)) + count > limit:
+            return False, ADMIT_LIMIT_REACHED
+
+    # رزرو سهمیه بلافاصله، تا پیام‌های همزمان از محدودیت عبور نکنند
+    for message_type, count in counts.items():
+        activity_counter.add((user_id, message_type), n=count)
+    return True, ADMIT_OK
+
+
+async def admit_message(user_id, message_type):
+    return await admit_messages(user_id, {message_type: 1})
+
+
+def reserve_shared_quota(connection, user_id, quotas):
+    # بررسی و افزایش اتمی شمارنده‌های مشترک بین worker ها در یک تراکنش
+    # quotas نگاشت نوع پیام -> (محدودیت، تعداد)
+    # تخمین پنجره لغزان: شمارش ساعت فعلی + سهم باقی‌مانده از ساعت قبل
+    now = datetime.now()
+    window_start = now.replace(minute=0, second=0, microsecond=0)
+    previous_start = window_start - timedelta(hours=1)
+    previous_weight = 1 - (now - window_start).total_seconds() / 3600
+    try:
+        with connection.cursor() as cursor:
+            # ترتیب ثابت قفل‌ها برای جلوگیری از deadlock
+            for message_type in sorted(quotas):
+                limit, count = quotas[message_type]
+                # ساخت یا قفل کردن ردیف ساعت فعلی؛ worker های دیگر تا commit منتظر می‌مانند
+                cursor.execute('''
+                    INSERT INTO rate_counters (user_id, message_type, window_start, count)
+                    VALUES (%s, %s, %s, 0)
+                    ON DUPLICATE KEY UPDATE count = count
+                ''', (user_id, message_type, window_start))
+                # FOR UPDATE تا ردیف ساعت قبل هم از آخرین commit خوانده شود، نه از snapshot تراکنش
+                cursor.execute('''
+                    SELECT window_start, count FROM rate_counters
+                    WHERE user_id = %s AND message_type = %s AND window_start IN (%s, %s)
+                    FOR UPDATE
+                ''', (user_id, message_type, window_start, previous_start))
+                used = dict(cursor.fetchall())
+
+                if used.get(window_start, 0) + used.get(previous_start, 0) * previous_weight + count > limit:
+                    connection.rollback()
                     return False
 
-        except Error as e:
-            logging.error(f"Database error in check_message_limits: {e}")
+                cursor.execute('''
+                    UPDATE rate_counters SET count = count + %s
+                    WHERE user_id = %s AND message_type = %s AND window_start = %s
+                ''', (count, user_id, message_type, window_start))
+            connection.commit()
+            return True
+
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error reserving shared quota: {e}")
+        return None
+
+
+def apply_upgrade(connection, user_id, new_level, txn_hash):
+    # ثبت تراکنش و تغییر سطح در یک تراکنش دیتابیس
+    # ایندکس یکتای txn_hash تضمین می‌کند از یک هش فقط یک بار استفاده شود
+    # برمی‌گرداند: True موفق، False هش تکراری، None خطا
+    try:
+        connection.start_transaction()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO transactions (user_id, level, txn_hash) VALUES (%s, %s, %s)",
+                (user_id, new_level, txn_hash))
+            cursor.execute(
+                "UPDATE users SET access_level = %s WHERE id = %s", (new_level, user_id))
+            cursor.execute('''
+                UPDATE pending_upgrades SET status = 'applied', pending_amount = NULL, txn_hash = %s
+                WHERE user_id = %s AND status = 'pending'
+            ''', (txn_hash, user_id))
+        connection.commit()
+        return True
+
+    except IntegrityError as e:
+        connection.rollback()
+        if e.errno == errorcode.ER_DUP_ENTRY:
             return False
-        finally:
-            conn.close()
-    return False
+        logging.error(f"Error applying upgrade: {e}")
+        return None
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error applying upgrade: {e}")
+        return None
 
 
-async def update_message_count(user_id, message_type):
-    conn = create_connection()
-    if conn is not None:
+def create_pending_upgrade(connection, user_id, new_level, price_units):
+    # یک مبلغ یکتا (قیمت + چند واحد کوچک) برای شناسایی خودکار واریز این کاربر
+    now = datetime.now()
+    expires_at = now + timedelta(seconds=PENDING_UPGRADE_TTL)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                UPDATE pending_upgrades SET status = 'cancelled', pending_amount = NULL
+                WHERE user_id = %s AND status = 'pending'
+            ''', (user_id,))
+            cursor.execute(
+                "SELECT pending_amount FROM pending_upgrades WHERE pending_amount BETWEEN %s AND %s",
+                (price_units + 1, price_units + 999))
+            taken = {row[0] for row in cursor.fetchall()}
+
+            for offset in range(1, 1000):
+                amount = price_units + offset
+                if amount in taken:
+                    continue
+                try:
+                    # created_at با ساعت همین سرور، مثل expires_at و block_ts مقایسه شده در reconciler
+                    cursor.execute('''
+                        INSERT INTO pending_upgrades (user_id, level, amount, pending_amount, created_at, expires_at)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                    ''', (user_id, new_level, amount, amount, now, expires_at))
+                except IntegrityError as e:
+                    if e.errno != errorcode.ER_DUP_ENTRY:
+                        raise
+                    continue  # همزمان توسط کاربر دیگری گرفته شد
+                connection.commit()
+                return amount
+
+        connection.rollback()
+        return None
+
+    except Error as e:
+        connection.rollback()
+        logging.error(f"Error creating pending upgrade: {e}")
+        return None
+
+
+def get_pending_upgrades(connection):
+    # درخواست‌های منقضی بسته می‌شوند و بقیه به صورت مبلغ -> (user_id, level, created_at) برمی‌گردند
+    run_query(connection, '''
+        UPDATE pending_upgrades SET status = 'expired', pending_amount = NULL
+        WHERE status = 'pending' AND expires_at < %s
+    ''', (datetime.now(),))
+    rows = run_query(connection, '''
+        SELECT pending_amount, user_id, level, created_at
+        FROM pending_upgrades
+        WHERE status = 'pending'
+    ''')
+    if rows is None:
+        return None
+    return {amount: (user_id, level, created_at) for amount, user_id, level, created_at in rows}
+
+
+def get_reconciler_cursor(connection):
+    rows = run_query(connection, "SELECT value FROM reconciler_state WHERE name = 'transfers_cursor'")
+    return int(rows[0][0]) if rows else 0
+
+
+def set_reconciler_cursor(connection, value):
+    return run_query(connection, '''
+        INSERT INTO reconciler_state (name, value) VALUES ('transfers_cursor', %s)
+        ON DUPLICATE KEY UPDATE value = VALUES(value)
+    ''', (str(value),))
+
+
+async def reconcile_transfers():
+    pending = await run_db(get_pending_upgrades)
+    if not pending:
+        return 0
+
+    # فقط واریزهای بعد از cursor و بعد از قدیمی‌ترین درخواست باز خوانده می‌شوند
+    cursor = await run_db(get_reconciler_cursor) or 0
+    oldest_ms = int(min(created_at for _, _, created_at in pending.values()).timestamp() * 1000)
+    transfers = await fetch_incoming_transfers(max(cursor, oldest_ms))
+    if transfers is None:
+        return 0
+
+    # cursor فقط تا آخرین واریز بررسی شده جلو می‌رود؛ با خطای دیتابیس همان واریز در دور بعد دوباره خوانده می‌شود
+    # (واریزهای اعمال شده دوباره با هش تکراری رد می‌شوند)
+    applied = 0
+    for transfer in transfers:
+        block_ts = int(transfer.get('block_ts', 0))
+        token = transfer.get('tokenInfo') or {}
+        match = pending.get(int(transfer.get('quant', 0)))
+        if (token.get('tokenAbbr') != 'USDT' or transfer.get('to_address') != WALLET_ADDRESS
+                or match is None or block_ts < match[2].timestamp() * 1000):
+            cursor = max(cursor, block_ts)
+            continue
+
+        user_id, new_level, _ = match
+        txn_hash = transfer['transaction_id'].lower()
+        result = await run_db(apply_upgrade, user_id, new_level, txn_hash)
+        if result is None:
+            break
+        cursor = max(cursor, block_ts)
+        if result:
+            await invalidate_user(user_id)
+            await clear_upgrade_state(user_id)
+            applied += 1
+            try:
+                await bot.send_message(user_id, f"پرداخت شما دریافت شد. سطح دسترسی شما به {new_level} ارتقا یافت!")
+            except TelegramAPIError as e:
+                logging.warning(f"Could not notify user {user_id} about upgrade: {e}")
+
+    await run_db(set_reconciler_cursor, cursor)
+    return applied
+
+
+async def clear_upgrade_state(user_id):
+    # کاربری که منتظر ارسال هش است، بعد از ارتقای خودکار از این state خارج می‌شود
+    state = FSMContext(storage=dp.storage, key=StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id))
+    if await state.get_state() == Upgrade.txn_hash.state:
+        await state.clear()
+
+
+async def run_reconciler():
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
         try:
+            applied = await run_exclusive('reconcile_transfers', reconcile_transfers)
+            if applied:
+                logging.info(f"Reconciler applied {applied} upgrades")
+        except Exception as e:
+            logging.error(f"Error in reconciler: {e}")
+
+
+async def is_transaction_used(txn_hash):
+    result = await execute_query("SELECT 1 FROM transactions WHERE txn_hash = %s", (txn_hash,))
+    return bool(result)
 
-            query = 'INSERT INTO messages (user_id, message_type, timestamp) VALUES (%s, %s, %s)'
-            execute_query(conn, query, (user_id, message_type, datetime.now()))
 
-        finally:
-            conn.close()
+async def update_message_count(user_id, message_type, count=1):
+    # با SHARED_STATE پیام‌ها فقط از دیتابیس به آمار اضافه می‌شوند تا دو بار شمرده نشوند
+    if not SHARED_STATE:
+        activity_stats.add(user_id, message_type, count)
+    for _ in range(count):
+        activity_writer.add(user_id, message_type)
 
 
 ############################################### Group Handler  ############################################
 
+class MediaGroupBuffer:
+    # بخش‌های یک آلبوم را تا window ثانیه بعد از اولین بخش جمع می‌کند
+    # و سپس همه را یکجا به on_complete می‌دهد
+
+    def __init__(self, window, on_complete):
+        self.window = window
+        self.on_complete = on_complete
+        self._groups = {}
+        self._tasks = set()
+
+    def add(self, message: Message):
+        parts = self._groups.get(message.media_group_id)
+        if parts is None:
+            parts = self._groups[message.media_group_id] = []
+            asyncio.get_running_loop().call_later(self.window, self._complete, message.media_group_id)
+        parts.append(message)
+
+    def _complete(self, media_group_id):
+        parts = self._groups.pop(media_group_id, None)
+        if parts:
+            task = asyncio.create_task(self.on_complete(parts))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+def reject_messages(messages, user_id, reason, message_type):
+    # پیام‌ها قبل از هشدار حذف می‌شوند، پس هشدار بدون reply ارسال می‌شود
+    chat_id = messages[0].chat.id
+    for message in messages:
+        outbound.delete_message(chat_id, message.message_id)
+
+    if reason == ADMIT_UNREGISTERED:
+        text = f'کاربر {user_id} قبل از ارسال پیام در گروه، با ربات زیر در چت خصوصی ثبت‌ نام کنید \n {BOT_USERNAME}'
+        warning_key = (chat_id, user_id, reason)
+    else:
+        text = f'شما با آیدی {user_id} به محدودیت پیام‌های {message_type} خود رسیده‌اید.'
+        warning_key = (chat_id, user_id, reason, message_type)
+    outbound.warn_once(chat_id, warning_key, partial(messages[0].answer, text))
+
+
+async def album_handler(messages):
+    # کل آلبوم با یک تصمیم پذیرفته یا رد می‌شود
+    user_id = messages[0].from_user.id
+    counts = Counter(message.content_type for message in messages)
+    allowed, reason = await admit_messages(user_id, counts)
+
+    if not allowed:
+        reject_messages(messages, user_id, reason, '/'.join(counts))
+        return
+
+    for message_type, count in counts.items():
+        await update_message_count(user_id, message_type, count)
+
+
+media_groups = MediaGroupBuffer(MEDIA_GROUP_WINDOW, album_handler)
+
+
 @dp.message(F.content_type.in_(['text', 'photo', 'animation', 'video', 'voice', 'video_note', 'video_chat_started']) & (F.chat.id == GROUP_ID))
 async def message_handler(message: Message):
     user_id = message.from_user.id
     # group_id = message.chat.id
     # print(f'{group_id=}')
 
-    if not await get_user_access_level(user_id):
-        await message.reply(f'کاربر {user_id} قبل از ارسال پیام در گروه، با ربات زیر در چت خصوصی ثبت‌ نام کنید \n {BOT_USERNAME}')
-        await message.delete()
+    if message.media_group_id:
+        media_groups.add(message)
         return
 
     message_type = message.content_type
+    allowed, reason = await admit_message(user_id, message_type)
 
-    if not await check_message_limits(user_id, message_type):
-        await message.reply(f'شما با آیدی {user_id} به محدودیت پیام‌های {message_type} خود رسیده‌اید.')
-        await message.delete()
+    if not allowed:
+        reject_messages([message], user_id, reason, message_type)
         return
 
     await update_message_count(user_id, message_type)
@@ -351,24 +1910,20 @@ async def process_purpose(message: types.Message, state: FSMContext):
     await state.clear()
 
     # Store user data in the database
-    connection = create_connection()
-    if connection:
-        try:
-            query = '''
-            INSERT INTO users (id,twitter_id, telegram_id, age, city, gender, purpose)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            '''
-            execute_query(connection, query, (
-                data['id'],
-                data['twitter_id'],
-                data['telegram_id'],
-                data['age'],
-                data['city'],
-                data['gender'],
-                data['purpose']
-            ))
-        finally:
-            connection.close()
+    query = '''
+    INSERT INTO users (id,twitter_id, telegram_id, age, city, gender, purpose)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    '''
+    await execute_query(query, (
+        data['id'],
+        data['twitter_id'],
+        data['telegram_id'],
+        data['age'],
+        data['city'],
+        data['gender'],
+        data['purpose']
+    ))
+    await invalidate_user(user_id)
 
     keyboard = ReplyKeyboardBuilder()
     keyboard.add(
@@ -390,15 +1945,119 @@ async def show_profile(message: types.Message, state: FSMContext):
     await message.answer('لطفاً یک پیام از کاربر مورد نظر برای ارتقاء فوروارد کنید.')
 
 
+async def send_users_export(message: types.Message, **options):
+    result = await run_db(partial(get_users_from_db, **options))
+    if not result:
+        await message.reply("Failed to connect to the database.")
+        return
+
+    file_path, count = result
+    try:
+        if count:
+            file = FSInputFile(file_path)  # استفاده از FSInputFile برای آپلود فایل
+            await message.reply_document(file, caption=f'{count} کاربر')
+        else:
+            await message.reply('کاربری با این شرایط پیدا نشد')
+    finally:
+        os.remove(file_path)  # حذف فایل پس از ارسال
+
+
 @dp.message((F.text == 'اطلاعات کاربرها') & (F.chat.type == 'private') & (F.chat.id.in_(ADMINS_ID)))
 async def show_profile(message: types.Message, state: FSMContext):
-    file_path = await asyncio.to_thread(get_users_from_db)
-    if file_path:
-        file = FSInputFile(file_path)  # استفاده از FSInputFile برای آپلود فایل
-        await message.reply_document(file)
-        os.remove(file_path)  # حذف فایل پس از ارسال
+    await send_users_export(message)
+
+
+@dp.message(F.text.startswith('/export') & (F.chat.type == 'private') & (F.chat.id.in_(ADMINS_ID)))
+async def export_users_handler(message: types.Message):
+    try:
+        options = parse_export_args(message.text)
+    except ValueError:
+        await message.reply('فرمت دستور: /export level=2 from=2024-01-01 to=2024-02-01 active=7 gzip|zip')
+        return
+    await send_users_export(message, **options)
+
+
+@dp.message((F.text == '/reload_levels') & (F.chat.type == 'private') & (F.chat.id.in_(ADMINS_ID)))
+async def reload_levels_handler(message: types.Message):
+    if await reload_levels():
+        await message.reply(f'جدول سطوح دسترسی بارگذاری شد ({len(levels_table)} سطح)')
     else:
-        await message.reply("Failed to connect to the database.")
+        await message.reply('خطا در بارگذاری جدول سطوح دسترسی')
+
+
+ACTIVITY_WINDOW_TITLES = {
+    'hour': 'ساعت گذشته',
+    'day': '۲۴ ساعت گذشته',
+    'week': '۷ روز گذشته',
+}
+
+
+def parse_activity_args(text):
+    # /activity 20 window=week  یا  /activity user=123
+    options = {}
+    for arg in text.split()[1:]:
+        key, _, value = arg.partition('=')
+        if key.isdigit() and not value:
+            options['top'] = max(1, min(int(key), ACTIVITY_TOP_MAX))
+        elif key == 'window' and value in ACTIVITY_WINDOW_TITLES:
+            options['window'] = value
+        elif key == 'user':
+            options['user_id'] = int(value)
+        else:
+            raise ValueError(arg)
+    return options
+
+
+def format_type_counts(window, user_id):
+    return ', '.join(f'{message_type}: {count}' for message_type in LIMIT_COLUMNS
+                     if (count := window.totals.get((user_id, message_type))))
+
+
+def format_user_activity(user_id):
+    lines = [f'فعالیت کاربر {user_id}:']
+    for name, title in ACTIVITY_WINDOW_TITLES.items():
+        window = activity_stats.window(name)
+        lines.append(f'{title}: {window.user_totals.get(user_id, 0)} ({format_type_counts(window, user_id) or "-"})')
+    return '\n'.join(lines)
+
+
+def format_activity_report(top, window_name, near_limits):
+    lines = ['فعالیت کاربران:']
+    for name, title in ACTIVITY_WINDOW_TITLES.items():
+        window = activity_stats.window(name)
+        lines.append(f'{title}: {window.total} پیام از {len(window.user_totals)} کاربر')
+
+    window = activity_stats.window(window_name)
+    lines.append(f'\n{top} کاربر پرفعالیت ({ACTIVITY_WINDOW_TITLES[window_name]}):')
+    leaders = activity_stats.top_users(window_name, top)
+    for rank, (user_id, total) in enumerate(leaders, 1):
+        lines.append(f'{rank}. {user_id}: {total} ({format_type_counts(window, user_id)})')
+    if not leaders:
+        lines.append('-')
+
+    lines.append('\nنزدیک‌ترین کاربران به محدودیت ساعتی:')
+    for _, user_id, level, message_type, count, limit in near_limits:
+        lines.append(f'{user_id} (سطح {level}): {message_type} {count}/{limit}')
+    if not near_limits:
+        lines.append('-')
+    return '\n'.join(lines)
+
+
+@dp.message(F.text.startswith('/activity') & (F.chat.type == 'private') & (F.chat.id.in_(ADMINS_ID)))
+async def activity_handler(message: types.Message):
+    try:
+        options = parse_activity_args(message.text)
+    except ValueError:
+        await message.reply('فرمت دستور: /activity 10 window=hour|day|week یا /activity user=123')
+        return
+
+    if 'user_id' in options:
+        await message.reply(format_user_activity(options['user_id']))
+        return
+
+    top = options.get('top', 10)
+    near_limits = await get_users_near_limits(top)
+    await message.reply(format_activity_report(top, options.get('window', 'day'), near_limits))
 
 
 @dp.message(AdminPromote.forward_id)
@@ -431,18 +2090,13 @@ async def handle_level(callback_query: types.CallbackQuery, state: FSMContext):
     data = await state.update_data(level=new_level)
     await state.clear()
 
-    connection = create_connection()
-    if connection:
-        try:
-            update_query = "UPDATE users SET access_level = %s WHERE id = %s"
-            execute_query(connection, update_query,
-                          (data['level'], data['forward_id']))
-
-            await callback_query.answer(f" سطح دسترسی کاربر {data['forward_id']} به {data['level']} ارتقا یافت!")
-            await bot.send_message(int(GROUP_ID),f" سطح دسترسی کاربر {data['forward_id']} به {data['level']} ارتقا یافت!")
+    update_query = "UPDATE users SET access_level = %s WHERE id = %s"
+    await execute_query(update_query, (data['level'], data['forward_id']))
+    await invalidate_user(data['forward_id'])
 
-        finally:
-            connection.close()
+    await callback_query.answer(f" سطح دسترسی کاربر {data['forward_id']} به {data['level']} ارتقا یافت!")
+    outbound.submit(PRIORITY_NOTICE, int(GROUP_ID), partial(
+        bot.send_message, int(GROUP_ID), f" سطح دسترسی کاربر {data['forward_id']} به {data['level']} ارتقا یافت!"))
 
 
 @dp.message((F.text == 'ارتقاء دسترسی') & (F.chat.type == 'private'))
@@ -477,79 +2131,69 @@ async def process_upgrade(callback_query: types.CallbackQuery, state: FSMContext
     user_id = callback_query.from_user.id
     new_level = int(callback_query.data.split('_')[1])
 
-    connection = create_connection()
-    if connection:
-        try:
-            query = "SELECT price FROM levels WHERE level = %s"
-            result = execute_query(connection, query, (new_level,))
-
-            if not result:
-                await callback_query.answer("خطا در دریافت اطلاعات سطح. لطفاً بعداً تلاش کنید.")
-                return
+    level = levels_table.get(new_level)
 
-            price = result[0][0]
+    if level is None:
+        await callback_query.answer("خطا در دریافت اطلاعات سطح. لطفاً بعداً تلاش کنید.")
+        return
 
-            await bot.send_message(
-                callback_query.from_user.id,
-                f"برای ارتقا به سطح {new_level}، لطفاً {price} تتر به آدرس زیر واریز کنید:\n{
-                    WALLET_ADDRESS}\nسپس هش تراکنش را ارسال کنید."
-            )
+    # مبلغ یکتا برای تطبیق خودکار؛ در صورت خطا همان قیمت سطح
+    amount_units = await run_db(create_pending_upgrade, user_id, new_level, to_units(level.price))
+    price = from_units(amount_units) if amount_units else str(level.price)
 
-            # ذخیره سطح جدید و قیمت در state
-            await state.update_data(new_level=new_level, price=price)
-            # تغییر وضعیت به دریافت هش تراکنش
-            await state.set_state(Upgrade.txn_hash)
+    await bot.send_message(
+        callback_query.from_user.id,
+        f"برای ارتقا به سطح {new_level}، لطفاً دقیقاً {price} تتر به آدرس زیر واریز کنید:\n{
+            WALLET_ADDRESS}\nارتقاء پس از تایید واریز به صورت خودکار انجام می‌شود. برای سرعت بیشتر می‌توانید هش تراکنش را ارسال کنید."
+    )
 
-        finally:
-            connection.close()
+    # ذخیره سطح جدید و قیمت در state
+    await state.update_data(new_level=new_level, price=price)
+    # تغییر وضعیت به دریافت هش تراکنش
+    await state.set_state(Upgrade.txn_hash)
 
 
-@dp.message(Upgrade.txn_hash)
+@dp.message(Upgrade.txn_hash, F.text.regexp(TXN_HASH_PATTERN))
 async def receive_txn_hash(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
 
     data = await state.get_data()
     new_level = data['new_level']
     price = data['price']
-    txn_hash = message.text
-
-    connection = create_connection()
-    if connection:
-        try:
-            if await verify_transaction(txn_hash, price):
-                txn_select_query = "SELECT user_id FROM transactions WHERE txn_hash = %s"
-                result = execute_query(
-                    connection, txn_select_query, (txn_hash,))
-                if result:
-                    await message.reply("این تراکنش قبلاً استفاده شده است.")
-                else:
-                    update_user_query = "UPDATE users SET access_level = %s WHERE id = %s"
-                    execute_query(connection, update_user_query,
-                                  (new_level, user_id))
-
-                    txn_insert_query = "INSERT INTO transactions (user_id, level, txn_hash) VALUES (%s, %s, %s)"
-                    execute_query(connection, txn_insert_query,
-                                  (user_id, new_level, txn_hash))
+    txn_hash = (message.text or '').strip().lower()
+    # مبلغ یکتا یا قیمت پایه سطح، برای کسی که قیمت اعلام شده سطح را پرداخته
+    # یا صرافی‌ای که مبلغ برداشت را به اعشار کمتر گرد می‌کند
+    level = levels_table.get(new_level)
+    amounts = [price] + ([level.price] if level is not None else [])
+
+    # بررسی محلی هش تکراری قبل از هر درخواست شبکه
+    if await is_transaction_used(txn_hash):
+        await message.reply("این تراکنش قبلاً استفاده شده است.")
+    elif await verify_transaction(txn_hash, *amounts):
+        applied = await run_db(apply_upgrade, user_id, new_level, txn_hash)
+        if applied:
+            await invalidate_user(user_id)
+            await message.reply(f"پرداخت {price} تتر تایید شد. سطح دسترسی شما به {new_level} ارتقا یافت!")
+        elif applied is False:
+            await message.reply("این تراکنش قبلاً استفاده شده است.")
+        else:
+            await message.reply("خطا در ثبت ارتقاء. لطفاً دوباره تلاش کنید.")
+    else:
+        await message.reply("خطا در تأیید تراکنش. لطفاً دوباره تلاش کنید.")
 
-                    await message.reply(f"پرداخت {price} تتر تایید شد. سطح دسترسی شما به {new_level} ارتقا یافت!")
-            else:
-                await message.reply("خطا در تأیید تراکنش. لطفاً دوباره تلاش کنید.")
-        finally:
-            connection.close()
+    # پاک کردن state
+    await state.clear()
 
-        # پاک کردن state
-        await state.clear()
 
+async def verify_transaction(txn_hash, *amounts):
+    # amounts: مبالغ قابل قبول به تتر
+    if not re.match(TXN_HASH_PATTERN, txn_hash or ''):
+        return False
 
-async def verify_transaction(txn_hash, amount):
-    amount = f"{int(float(amount) * 1e6)}"
-    url = f"https://apilist.tronscan.org/api/transaction-info?hash={txn_hash}"
-    async with AsyncSession() as session:
-        response = await session.get(url, impersonate='chrome')
-        if response.ok:
-            data = response.json().get('tokenTransferInfo', None)
-            if data and data['symbol'] == 'USDT' and data['to_address'] == WALLET_ADDRESS and data['amount_str'] == amount:
-                return True
+    accepted = {f"{to_units(amount)}" for amount in amounts}
+    data = await tronscan.get_transfer(txn_hash)
+    if data and data['symbol'] == 'USDT' and data['to_address'] == WALLET_ADDRESS and data['amount_str'] in accepted:
+        return True
 
     return False
 
@@ -557,23 +2201,92 @@ async def verify_transaction(txn_hash, amount):
 @dp.message((F.text == 'پروفایل من') & (F.chat.type == 'private'))
 async def show_profile(message: types.Message):
     user_id = message.from_user.id
-    connection = create_connection()
-    if connection:
-        try:
-            query = 'SELECT access_level FROM users WHERE id = %s'
-            result = execute_query(connection, query, (user_id,))
+    query = 'SELECT access_level FROM users WHERE id = %s'
+    result = await execute_query(query, (user_id,))
 
-            if result:
-                await message.reply(f'شما با آیدی {user_id} دسترسی سطح {result[0][0]} دارید')
-            else:
-                await message.reply('خطای دریافت اطلاعات پروفایل  . بعدا امتحان کنید')
-        finally:
-            connection.close()
-    else:
+    if result:
+        await message.reply(f'شما با آیدی {user_id} دسترسی سطح {result[0][0]} دارید')
+    elif result is None:
         await message.reply('خطای ارتباط با دیتابیس . بعدا امتحان کنید')
+    else:
+        await message.reply('خطای دریافت اطلاعات پروفایل  . بعدا امتحان کنید')
 
 
-async def main():
-    await dp.start_polling(bot)
+# بعد از همه handler ها ثبت می‌شود تا دکمه‌ها در انتظار هش هم کار کنند
+@dp.message(Upgrade.txn_hash, F.chat.type == 'private')
+async def invalid_txn_hash(message: types.Message):
+    await message.reply('هش تراکنش باید ۶۴ کاراکتر (0-9 و a-f) باشد. '
+                        'ارسال هش اختیاری است و ارتقاء پس از تایید واریز به صورت خودکار انجام می‌شود.')
+
+
+async def run_webhook():
+    # سرور aiohttp پشت reverse proxy؛ درخواست‌ها با هدر secret token اعتبارسنجی می‌شوند
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError('WEBHOOK_URL and WEBHOOK_SECRET are required in webhook mode')
 
-asyncio.run(main())
+    app = web.Application()
+    # پاسخ به تلگرام بعد از قرار گرفتن آپدیت در update_executor، تا صف پر درخواست‌ها را نگه دارد
+    # و تلگرام ارسال را تا آزاد شدن جا به تعویق بیندازد
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET,
+                         handle_in_background=False).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+        logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def main():
+    open_db_pool()
+    tronscan.start()
+    await prepare_schema()
+    await reload_levels()
+    if not SHARED_STATE:
+        await run_db(load_recent_activity)
+    await refresh_activity_stats()
+    activity_writer.start()
+    outbound.start()
+    update_executor.start()
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT, METRICS_PATH)
+        logging.info(f"Metrics available on {METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+    tasks = [
+        asyncio.create_task(evict_idle_activity()),
+        asyncio.create_task(watch_levels()),
+        asyncio.create_task(maintain_messages()),
+        asyncio.create_task(run_reconciler()),
+    ]
+    if isinstance(fsm_storage, MySQLStorage):
+        tasks.append(asyncio.create_task(evict_fsm_states()))
+    if SHARED_STATE:
+        tasks.append(asyncio.create_task(watch_invalidations()))
+        tasks.append(asyncio.create_task(watch_activity_stats()))
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            # همزمانی و ترتیب آپدیت‌ها با update_executor است
+            await dp.start_polling(bot, handle_as_tasks=False)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await update_executor.stop()
+        await outbound.stop()
+        await activity_writer.stop()
+        await tronscan.close()
+        close_db_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
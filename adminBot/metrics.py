@@ -0,0 +1,175 @@
+import threading
+import time
+from bisect import bisect_left
+from enum import Enum
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+
+# مرزهای پیش‌فرض histogram زمان (ثانیه)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    # مثلا ContentType.TEXT -> text
+    if isinstance(value, Enum):
+        value = value.value
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    # متریک با برچسب؛ مقدار هر ترکیب برچسب جدا نگه داشته می‌شود
+    # از ترد‌های دیتابیس هم فراخوانی می‌شود، پس تغییرات زیر قفل انجام می‌شوند
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+
+class Gauge(_Metric):
+    # مقدار در لحظه خواندن از func گرفته می‌شود (مثلا طول یک صف)
+    # برای شمارنده‌هایی که جای دیگری نگه داشته می‌شوند kind='counter' داده می‌شود
+    kind = 'gauge'
+
+    def __init__(self, name, description, func, kind='gauge'):
+        super().__init__(name, description)
+        self.func = func
+        self.kind = kind
+
+    def render(self):
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}',
+                f'{self.name} {self.func()}']
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [شمارش هر سطل (بدون تجمع)، جمع، تعداد]
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, [("le", bound)])} {cumulative}')
+        lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, [("le", "+Inf")])} {count}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total}')
+        lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, func, kind='gauge'):
+        return self.register(Gauge(name, description, func, kind))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    # زمان اجرای هر handler به نام تابع آن؛ به صورت inner middleware ثبت می‌شود
+    # تا فقط آپدیت‌هایی که به یک handler رسیده‌اند شمرده شوند
+
+    def __init__(self, latency, errors):
+        self.latency = latency
+        self.errors = errors
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors.inc(handler=name)
+            raise
+        finally:
+            self.latency.observe(time.perf_counter() - started, handler=name)
+
+
+async def _metrics_view(request):
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(host, port, path='/metrics'):
+    # برمی‌گرداند: AppRunner که هنگام خروج باید cleanup شود
+    app = web.Application()
+    app.router.add_get(path, _metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
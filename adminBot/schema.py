@@ -0,0 +1,217 @@
+import logging
+from datetime import datetime
+
+
+# جداول پایه؛ روی دیتابیس موجود چیزی را تغییر نمی‌دهد
+def _migration_1(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT NOT NULL PRIMARY KEY,
+            twitter_id VARCHAR(64),
+            telegram_id VARCHAR(64),
+            age INT,
+            city VARCHAR(128),
+            gender VARCHAR(32),
+            purpose TEXT,
+            access_level INT NOT NULL DEFAULT 1,
+            registration_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # -1 یعنی نامحدود و 0 یعنی غیرمجاز
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS levels (
+            level INT NOT NULL PRIMARY KEY,
+            price DECIMAL(18, 6) NOT NULL,
+            text_limit INT NOT NULL DEFAULT 0,
+            gif_limit INT NOT NULL DEFAULT 0,
+            photo_limit INT NOT NULL DEFAULT 0,
+            video_limit INT NOT NULL DEFAULT 0,
+            video_note_limit INT NOT NULL DEFAULT 0,
+            voice_limit INT NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            message_type VARCHAR(32) NOT NULL,
+            timestamp DATETIME NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            level INT NOT NULL,
+            txn_hash VARCHAR(128) NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_stats_hourly (
+            user_id BIGINT NOT NULL,
+            message_type VARCHAR(32) NOT NULL,
+            hour DATETIME NOT NULL,
+            count INT NOT NULL,
+            PRIMARY KEY (user_id, message_type, hour)
+        )
+    ''')
+
+
+# ایندکس‌های مسیرهای پرتکرار، برای جداولی که قبل از این ماژول ساخته شده‌اند
+def _migration_2(cursor):
+    # rollup جدول messages به کلید id نیاز دارد
+    if not _column_exists(cursor, 'messages', 'id'):
+        cursor.execute(
+            'ALTER TABLE messages ADD COLUMN id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY FIRST')
+
+    _create_index(cursor, 'messages', 'idx_messages_user_type_ts',
+                  'user_id, message_type, timestamp')
+    _create_index(cursor, 'messages', 'idx_messages_timestamp', 'timestamp')
+    _create_index(cursor, 'transactions', 'uq_transactions_txn_hash',
+                  'txn_hash', unique=True)
+
+
+# درخواست‌های ارتقاء در انتظار پرداخت و وضعیت reconciler
+def _migration_3(cursor):
+    # pending_amount فقط برای درخواست‌های باز مقدار دارد و یکتا است،
+    # تا هر واریز دقیقاً به یک درخواست نسبت داده شود
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_upgrades (
+            id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            level INT NOT NULL,
+            amount BIGINT NOT NULL,
+            pending_amount BIGINT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'pending',
+            txn_hash VARCHAR(128) NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL,
+            UNIQUE KEY uq_pending_upgrades_amount (pending_amount),
+            KEY idx_pending_upgrades_user_status (user_id, status)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconciler_state (
+            name VARCHAR(64) NOT NULL PRIMARY KEY,
+            value VARCHAR(255) NOT NULL
+        )
+    ''')
+
+
+# state های FSM که باید بعد از ری‌استارت باقی بمانند
+def _migration_4(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            storage_key VARCHAR(255) NOT NULL PRIMARY KEY,
+            state VARCHAR(255) NULL,
+            data TEXT NOT NULL,
+            expires_at DATETIME NOT NULL,
+            KEY idx_fsm_states_expires (expires_at)
+        )
+    ''')
+
+
+# وضعیت مشترک بین چند worker
+def _migration_5(cursor):
+    # شمارنده ساعتی پیام‌ها؛ window_start شروع ساعت است
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rate_counters (
+            user_id BIGINT NOT NULL,
+            message_type VARCHAR(32) NOT NULL,
+            window_start DATETIME NOT NULL,
+            count INT NOT NULL,
+            PRIMARY KEY (user_id, message_type, window_start),
+            KEY idx_rate_counters_window (window_start)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            KEY idx_cache_invalidations_created (created_at)
+        )
+    ''')
+
+
+# گزارش فعالیت هنگام شروع هفته گذشته را از message_stats_hourly می‌خواند
+def _migration_6(cursor):
+    _create_index(cursor, 'message_stats_hourly', 'idx_message_stats_hourly_hour', 'hour')
+
+
+MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+    (5, _migration_5),
+    (6, _migration_6),
+]
+
+# کوئری‌های مسیر پرتکرار که نباید full table scan انجام دهند
+HOT_PATH_QUERIES = {
+    'is_user_registered': (
+        'SELECT access_level FROM users WHERE id = %s',
+        (0,),
+    ),
+    'message_limits': (
+        'SELECT COUNT(*) FROM messages WHERE user_id = %s AND message_type = %s AND timestamp > %s',
+        (0, 'text', datetime(1970, 1, 1)),
+    ),
+    'transaction_lookup': (
+        'SELECT user_id FROM transactions WHERE txn_hash = %s',
+        ('',),
+    ),
+}
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute('''
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    ''', (table, column))
+    return cursor.fetchone() is not None
+
+
+def _create_index(cursor, table, name, columns, unique=False):
+    # MySQL دستور CREATE INDEX IF NOT EXISTS ندارد
+    cursor.execute('''
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+    ''', (table, name))
+    if cursor.fetchone() is None:
+        logging.info(f"Creating index {name} on {table}({columns})")
+        cursor.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} ({columns})")
+
+
+def migrate(connection):
+    with connection.cursor(buffered=True) as cursor:
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL PRIMARY KEY)')
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+        current = cursor.fetchone()[0]
+
+        for version, step in MIGRATIONS:
+            if version <= current:
+                continue
+            logging.info(f"Applying schema migration {version}")
+            step(cursor)
+            cursor.execute('INSERT INTO schema_version (version) VALUES (%s)', (version,))
+            connection.commit()
+            current = version
+
+    return current
+
+
+def explain_hot_paths(connection):
+    # برمی‌گرداند: لیست (نام کوئری، جدول) هایی که بدون ایندکس اسکن می‌شوند
+    problems = []
+    with connection.cursor(buffered=True, dictionary=True) as cursor:
+        for name, (query, params) in HOT_PATH_QUERIES.items():
+            cursor.execute(f'EXPLAIN {query}', params)
+            for row in cursor.fetchall():
+                if row.get('type') == 'ALL':
+                    problems.append((name, row.get('table')))
+    return problems
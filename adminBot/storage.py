@@ -0,0 +1,148 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from mysql.connector import Error
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+
+def _select_state(connection, storage_key):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT state, data FROM fsm_states
+                WHERE storage_key = %s AND expires_at > %s
+            ''', (storage_key, datetime.now()))
+            return cursor.fetchall()
+
+    except Error as e:
+        logging.error(f"Error reading FSM state: {e}")
+        return None
+
+
+def _save_state(connection, storage_key, state, data, expires_at):
+    try:
+        with connection.cursor() as cursor:
+            if state is None and not data:
+                cursor.execute('DELETE FROM fsm_states WHERE storage_key = %s', (storage_key,))
+            else:
+                cursor.execute('''
+                    INSERT INTO fsm_states (storage_key, state, data, expires_at)
+                    VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        state = VALUES(state), data = VALUES(data), expires_at = VALUES(expires_at)
+                ''', (storage_key, state, json.dumps(data, ensure_ascii=False), expires_at))
+            connection.commit()
+            return True
+
+    except Error as e:
+        logging.error(f"Error saving FSM state: {e}")
+        return None
+
+
+def _delete_expired(connection, batch_size):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM fsm_states WHERE expires_at < %s LIMIT %s',
+                           (datetime.now(), batch_size))
+            connection.commit()
+            return cursor.rowcount
+
+    except Error as e:
+        logging.error(f"Error evicting FSM states: {e}")
+        return None
+
+
+class MySQLStorage(BaseStorage):
+    # ذخیره‌سازی FSM در جدول fsm_states که با ری‌استارت از بین نمی‌رود
+    # state های رها شده بعد از ttl ثانیه حذف می‌شوند؛ کلیدهای پرکاربرد در یک کش LRU کوچک می‌مانند
+    # run_db همان تابع main.py است که یک تابع همگام را با کانکشن pool اجرا می‌کند
+
+    def __init__(self, run_db, ttl, cache_size=1000):
+        self.run_db = run_db
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        # کلیدهای بدون state جدا نگه داشته می‌شوند تا کاربران زیادی که فرایندی ندارند
+        # state های فعال (ثبت نام، پرداخت) را از کش بیرون نکنند
+        self._empty = OrderedDict()
+
+    @staticmethod
+    def _make_key(key: StorageKey):
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny))
+
+    def _remember(self, storage_key, state, data):
+        if self.cache_size <= 0:
+            return
+        if state is None and not data:
+            self._cache.pop(storage_key, None)
+            cache = self._empty
+        else:
+            self._empty.pop(storage_key, None)
+            cache = self._cache
+        cache[storage_key] = (state, data, time.monotonic() + self.ttl)
+        cache.move_to_end(storage_key)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    async def _load(self, storage_key):
+        now = time.monotonic()
+        for cache in (self._cache, self._empty):
+            entry = cache.get(storage_key)
+            if entry is not None and entry[2] > now:
+                cache.move_to_end(storage_key)
+                return entry[0], entry[1]
+
+        rows = await self.run_db(_select_state, storage_key)
+        # خطای خواندن نباید state خالی حساب شود، وگرنه set_state و set_data آن را روی پیشرفت کاربر می‌نویسند
+        if rows is None:
+            raise RuntimeError(f'Could not read FSM state for {storage_key}')
+        state, data = (rows[0][0], json.loads(rows[0][1])) if rows else (None, {})
+        self._remember(storage_key, state, data)
+        return state, data
+
+    async def _save(self, storage_key, state, data):
+        self._remember(storage_key, state, data)
+        expires_at = datetime.now() + timedelta(seconds=self.ttl)
+        await self.run_db(_save_state, storage_key, state, data, expires_at)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        storage_key = self._make_key(key)
+        _, data = await self._load(storage_key)
+        await self._save(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey):
+        state, _ = await self._load(self._make_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        storage_key = self._make_key(key)
+        state, _ = await self._load(storage_key)
+        await self._save(storage_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey):
+        _, data = await self._load(self._make_key(key))
+        return dict(data)
+
+    async def evict_expired(self, batch_size=1000):
+        now = time.monotonic()
+        for cache in (self._cache, self._empty):
+            for storage_key in [k for k, entry in cache.items() if entry[2] <= now]:
+                del cache[storage_key]
+
+        total = 0
+        while True:
+            deleted = await self.run_db(_delete_expired, batch_size)
+            if not deleted:
+                return total
+            total += deleted
+
+    async def close(self) -> None:
+        self._cache.clear()
+        self._empty.clear()